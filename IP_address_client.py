@@ -1,87 +1,127 @@
 import sys
 import time
-import json
 import argparse
-import logging, logging.config
 import signal
+import os
+import tempfile
+from html import escape
 
-from mqtt_client import MqttClient
+from mqtt_config import ConfigError, load_config, create_logger, start_logging
+from dashboard_server import DashboardServer
+from host_registry import HostRegistry
+from mqtt_metrics import MetricsRegistry, serve_metrics
 
-def checkConfig(config, required_keys):
-    return all(k in config for k in required_keys)
-      
-def create_html(ip_lst):
-    html_start = '''
+HTML_START = '''
         <!DOCTYPE html><html lang="en"><head><meta charset="UTF-8" /><meta name="viewport" content="width=device-width, initial-scale=1.0" /><title>Pickle System Ip Addresses</title><style>
         body {margin: 0;padding: 0;height: 100vh;display: flex;align-items: center;justify-content: center;background: linear-gradient(to right, #f0f2f5, #e0e7ff);font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;}
         select {width: 80ch;font-size: 1rem;padding: 10px;border-radius: 8px;border: 1px solid #ccc;box-shadow: 0 2px 5px rgba(0,0,0,0.1);background-color: white;}</style></head><body>'''
+HTML_END = "</body></html>\n"
+# when served by DashboardServer, keep the list current from /events
+HTML_LIVE_SCRIPT = '''<script>
+        new EventSource("/events").onmessage = function(e) {
+            var sel = document.querySelector("select"); sel.textContent = "";
+            JSON.parse(e.data).hosts.forEach(function(h) {
+                var o = document.createElement("option"); o.textContent = h.topic + ": " + h.payload + (h.stale ? " (stale)" : ""); sel.appendChild(o); });
+        };</script>'''
 
-    entry_cnt = len(ip_lst) if len(ip_lst) >= 1 and len(ip_lst) <= 30 else 10 
-    html_mid = f'<select size="{entry_cnt}">'
-    for ip in ip_lst:
-        html_mid += f"<option>{ip}</option>"
-    html_mid += "</select>"
+def create_html(ip_lst, live=False, total=None):
+    entry_cnt = max(1, min(len(ip_lst), 30))
+    # entries carry payloads from any client on the broker, never trust them as markup
+    options = "".join(f"<option>{escape(ip)}</option>" for ip in ip_lst)
+    script = HTML_LIVE_SCRIPT if live else ""
+    # the page only lists the first html_page_size hosts; /api/hosts pages through the rest
+    more = f"<p>Showing {len(ip_lst)} of {total} hosts</p>" if total != None and total > len(ip_lst) else ""
+    return f'{HTML_START}<select size="{entry_cnt}">{options}</select>{more}{script}{HTML_END}'
 
-    html_end = "</body></html>\n"
-    
-    return html_start + html_mid + html_end
+def format_host(entry, registry, now):
+    if registry.is_stale(entry, now):
+        return f"{entry.topic}: {entry.payload} (stale, last seen {entry.age_s(now) / 3600:.1f}h ago)"
+    return f"{entry.topic}: {entry.payload}"
+
+def create_json(entries, total, registry, now, offset=0):
+    return {"total": total,
+            "offset": offset,
+            "hosts": [{"topic": entry.topic, "payload": entry.payload, "ip_address": entry.ip_address,
+                       "received": entry.received, "last_seen": entry.last_seen,
+                       "stale": registry.is_stale(entry, now)}
+                      for entry in entries]}
 
 def save_html_file(fname, html):
-    with open(fname, "w") as file:
-        file.write(html)
+    # write to a temp file in the same directory and rename it over the
+    # target, so a web server never serves a half-written page
+    dir_name = os.path.dirname(os.path.abspath(fname))
+    fd, tmp_name = tempfile.mkstemp(dir=dir_name, prefix=".index-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(html)
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, fname)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
   
-if __name__ == "__main__":
+def run(config, logger):
+    """
+    Subscribes and keeps the dashboard (file and/or embedded HTTP server)
+    current until SIGINT. 'config' must already be validated (see
+    mqtt_config); paho and ssl are only imported from here on.
+    """
+    from mqtt_client import MqttClient
+    from mqtt_sharded import ShardedMqttClient
+
     done = False
     def sigint_handler(signal, frame):
-        global done
+        nonlocal done
         print( "\nShutting down...")
         done = True
     signal.signal(signal.SIGINT, sigint_handler)
-    
-    parser = argparse.ArgumentParser(description='MQTT Client')
-    parser.add_argument('-c', '--config_file_path', action="store", default='mqtt_client_config.json', help='path to config file')
-    args = parser.parse_args()
-
-    logFormatter = logging.Formatter("%(asctime)s [%(name)s] (%(levelname)s): %(message)s")
-    logger = logging.getLogger("mqtt_client")
-    logger.setLevel(logging.DEBUG)
-    consoleHandler = logging.StreamHandler(sys.stdout)
-    consoleHandler.setFormatter(logFormatter)
-    logger.addHandler(consoleHandler)
-    
-    try:
-        with open(args.config_file_path) as config_file:
-            try:
-                config = json.load(config_file)
-            except ValueError:
-                logger.error("Error parsing config file: %s" % (args.config_file_path))
-                raise
-                sys.exit()
-    except FileNotFoundError:
-        logger.error("Error! Config file not found: %s" % (args.config_file_path))
-        sys.exit()
-        
-    required_keys = ("client_id","client_username","client_pw","hivemq_url","hivemq_port",
-                     "clean_start","topic_list","subscribe_qos","sleep_time_s")        
-    if not checkConfig(config, required_keys):
-        logger.error(f"Config file ({args.config_file_path}) does not contain correct attributes")
-        sys.exit()
-        
-    sleep_time_s   = config["sleep_time_s"] if "sleep_time_s" in config else 10
+
+    render_debounce_s = config["render_debounce_s"] if "render_debounce_s" in config else 0.05
     html_file_name = config["html_file_name"] if "html_file_name" in config else "index.html"
-    msg_truncate_value = config["msg_truncate_value"] if "msg_truncate_value" in config else 20
-    log_file_name = config["log_file_name"] if "log_file_name" in config else "ip_client.log"
-    
-    fileHandler = logging.FileHandler(log_file_name)
-    fileHandler.setFormatter(logFormatter)
-    logger.addHandler(fileHandler)
+    # with http_port set the page is served from memory, and only written
+    # to html_file_name as well if write_html_file is true
+    http_port = config["http_port"] if "http_port" in config else None
+    http_host = config["http_host"] if "http_host" in config else "0.0.0.0"
+    write_html_file = config["write_html_file"] if "write_html_file" in config else http_port == None
+    # /metrics is served by the dashboard when there is one, else on metrics_port
+    metrics_port = config["metrics_port"] if "metrics_port" in config else None
+    # hosts expire host_ttl_s after they were last seen and are marked stale
+    # after host_stale_after_s; the page is re-rendered every stale_check_s
+    # so those markers move on even when nothing is published
+    host_ttl_s = config["host_ttl_s"] if "host_ttl_s" in config else 7 * 24 * 3600
+    host_stale_after_s = config["host_stale_after_s"] if "host_stale_after_s" in config else 3600
+    max_hosts = config["max_hosts"] if "max_hosts" in config else 100000
+    html_page_size = config["html_page_size"] if "html_page_size" in config else 500
+    stale_check_s = config["stale_check_s"] if "stale_check_s" in config else 60
     
     logger.info("*** Starting IP Address Message Utility. ***")
     logger.info(f"  Listening for IP address MQTT msgs for these topics: {config['topic_list']}")
-    logger.info(f"  Writing HTML file with addresses: {html_file_name}\n")
+    if write_html_file:
+        logger.info(f"  Writing HTML file with addresses: {html_file_name}\n")
+
+    metrics = MetricsRegistry()
+    render_seconds = metrics.histogram("dashboard_render_seconds", "Time to render the dashboard")
+    metrics_server = None
+    registry = HostRegistry(ttl_s=host_ttl_s, stale_after_s=host_stale_after_s, max_hosts=max_hosts)
+    def hosts_page(offset, limit):
+        entries, total = registry.page(offset, limit)
+        return create_json(entries, total, registry, time.time(), offset)
+    dashboard = None
+    if http_port != None:
+        dashboard = DashboardServer(http_host, http_port, logger, metrics=metrics, hosts_page=hosts_page)
+        dashboard.start()
+    elif metrics_port != None:
+        metrics_server = serve_metrics(metrics, http_host, metrics_port)
     
     logger.info("Creating MQTT Client")
-    mqtt_client = MqttClient(config, logger)
+    # several connections (or brokers) when configured, merged into one store
+    sharded = ("brokers" in config and config["brokers"]) or \
+        ("connections" in config and (config["connections"] or 1) > 1)
+    client_class = ShardedMqttClient if sharded else MqttClient
+    mqtt_client = client_class(config, logger, metrics=metrics)
+    # hosts the registry lets go of are dropped from the client's per-topic
+    # index too, unless they were republished since the last read
+    registry.on_remove = lambda topic: mqtt_client.forget(topic, seq)
 
     logger.info("Setting up and connecting")
     mqtt_client.setup()
@@ -89,15 +129,84 @@ if __name__ == "__main__":
         
     logger.info("Starting process loop...")
     mqtt_client.start()
+    seq = 0
+    last_html = None
+    next_stale_check = 0
+    skipped_renders = 0
     while not done:
-        ip_lst = mqtt_client.get_msgs(msg_truncate_value)
-        html   = create_html(ip_lst)
-        save_html_file(html_file_name, html)
+        # sleep until a message arrives; the timeout only bounds how long a
+        # ctrl-c takes to be noticed
+        stale_check = time.time() >= next_stale_check
+        if mqtt_client.wait_for_msgs(seq, timeout=0.5) == seq:
+            if last_html != None and not stale_check:
+                continue
+        # let a burst of publishes coalesce into a single render
+        elif render_debounce_s > 0:
+            time.sleep(render_debounce_s)
+
+        changed, seq = mqtt_client.get_changed_since(seq)
+        mqtt_client.decode_records(changed)
+        for record in changed:
+            registry.update(record)
+        expired = registry.expire()
+        if expired > 0:
+            logger.info(f"Expired {expired} hosts not seen for {host_ttl_s}s")
 
-        for _ in range(sleep_time_s * 2):
-            if done: break
-            time.sleep((1 / 2))
+        # only rebuild the page when something changed, and only rewrite
+        # the file when the page content actually differs (a host may
+        # republish the same address)
+        html = last_html
+        if changed or expired or stale_check or last_html == None:
+            render_started = time.perf_counter()
+            now = time.time()
+            entries, total = registry.page(0, html_page_size)
+            html = create_html([format_host(entry, registry, now) for entry in entries],
+                               live=dashboard != None, total=total)
+            if dashboard != None:
+                dashboard.update(html, create_json(entries, total, registry, now))
+            render_seconds.observe(time.perf_counter() - render_started)
+            next_stale_check = now + stale_check_s
+        if html != last_html:
+            if write_html_file:
+                save_html_file(html_file_name, html)
+            last_html = html
+            if skipped_renders > 0:
+                logger.info(f"Wrote {html_file_name} after skipping {skipped_renders} unchanged renders")
+            skipped_renders = 0
+        else:
+            skipped_renders += 1
 
+    if skipped_renders > 0:
+        logger.info(f"Skipped {skipped_renders} unchanged renders")
+    logger.info(f"Connection stats: {mqtt_client.get_connection_stats()}")
+    logger.info(f"Callback stats: {mqtt_client.get_callback_stats()}")
+    logger.info(f"Host registry stats: {registry.get_stats()}")
     logger.info("Stopping client loop and disconnecting")
     mqtt_client.stop()
     mqtt_client.disconnect()
+    if dashboard != None:
+        dashboard.stop()
+    if metrics_server != None:
+        metrics_server.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MQTT Client')
+    parser.add_argument('-c', '--config_file_path', action="store", default='mqtt_client_config.json', help='path to config file')
+    args = parser.parse_args(argv)
+
+    logger, console_handler = create_logger("mqtt_client")
+    try:
+        config = load_config(args.config_file_path, "client", logger)
+    except ConfigError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+    # console and file writes happen on a listener thread, not in the MQTT callbacks
+    log_listener = start_logging(logger, console_handler, config, "ip_client.log")
+    try:
+        run(config, logger)
+    finally:
+        log_listener.stop()
+
+if __name__ == "__main__":
+    main()
@@ -1,89 +1,218 @@
 import socket
-import fcntl
-import struct
 import sys
 import argparse
-import logging, logging.config
-import json
-from datetime import datetime
-
-from mqtt_publisher import MqttPublisher
-
-def checkConfig(config, required_keys):
-    return all(k in config for k in required_keys)
-      
-def get_ip_address(ifname):
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return socket.inet_ntoa(fcntl.ioctl(
-        s.fileno(),
-        0x8915,  # SIOCGIFADDR
-        struct.pack('256s', ifname[:15].encode('utf-8'))
-    )[20:24])
-
-def main():
-    parser = argparse.ArgumentParser(description='MQTT Client')
-    parser.add_argument('-c', '--config_file_path', action="store", default='mqtt_client_config.json', help='path to config file')
-    args = parser.parse_args()
-
-    logFormatter = logging.Formatter("%(asctime)s [%(name)s] (%(levelname)s): %(message)s")
-    logger = logging.getLogger("mqtt_client")
-    logger.setLevel(logging.DEBUG)
-    consoleHandler = logging.StreamHandler(sys.stdout)
-    consoleHandler.setFormatter(logFormatter)
-    logger.addHandler(consoleHandler)
-    
+import select
+import signal
+import time
+
+from mqtt_config import ConfigError, load_config, create_logger, start_logging
+from mqtt_metrics import MetricsRegistry, serve_metrics
+from ip_collector import get_ip_addresses
+from mqtt_codec import get_codec, publish_properties, PAYLOAD_UTF8
+
+# netlink multicast groups for interface address changes (RTM_NEWADDR/RTM_DELADDR)
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+def open_addr_watch():
+    # returns a netlink socket that becomes readable when any interface
+    # address changes, or None where netlink is not available
     try:
-        with open(args.config_file_path) as config_file:
-            try:
-                config = json.load(config_file)
-            except ValueError:
-                logger.error("Error parsing config file: %s" % (args.config_file_path))
-                raise
-                sys.exit()
-    except FileNotFoundError:
-        logger.error("Error! Config file not found: %s" % (args.config_file_path))
-        sys.exit()
-
-    required_keys = ("client_id","client_username","client_pw","hivemq_url","hivemq_port",
-                     "topic_list","publish_qos","ifname")        
-    if not checkConfig(config, required_keys):
-        logger.error(f"Config file ({args.config_file_path}) does not contain correct attributes")
-        sys.exit()
-
-    log_file_name = config["log_file_name"] if "log_file_name" in config else "ip_publisher.log"
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        sock.setblocking(False)
+        return sock
+    except (AttributeError, OSError):
+        return None
+
+def wait_for_addr_change(sock, timeout):
+    # True if an address event arrived within 'timeout' seconds. The events
+    # themselves are discarded, the caller re-reads the address instead.
+    if sock == None:
+        time.sleep(timeout)
+        return False
+    ready, _, _ = select.select([sock], [], [], timeout)
+    if not ready:
+        return False
+    while True:
+        try:
+            sock.recv(65536)
+        except BlockingIOError:
+            return True
+
+def create_message(interfaces, codec=None):
+    # "ip_address" stays the single primary IPv4 address for older subscribers
+    if codec == None:
+        codec = get_codec("json")
+    return codec.encode(time.time(), interfaces)
+
+def describe_message(message, codec):
+    if codec.payload_format == PAYLOAD_UTF8:
+        return message.decode("UTF-8")
+    return f"{len(message)} bytes {codec.name}"
+
+def publish_message(mqtt_client, logger, pub_topic_list, message, retain, codec=None, wait=True):
+    logger.info(f"Publishing to topics: {pub_topic_list}")
+    # announce the codec so MqttClient decodes to match (MQTT v5)
+    properties = publish_properties(codec) if codec != None else None
+    if mqtt_client.outbox != None:
+        # durable once written; the drainer sends it whenever connected
+        for pub_topic in pub_topic_list:
+            mqtt_client.enqueue(pub_topic, message, retain, properties)
+        if not wait:
+            return True
+        timeout = mqtt_client.config["publish_timeout_s"] if "publish_timeout_s" in mqtt_client.config else 10
+        if not mqtt_client.flush(timeout):
+            logger.warning(f"Not delivered within {timeout}s, {len(mqtt_client.outbox)} messages "
+                           f"kept in the outbox for the next run")
+            return False
+        return True
+    results, stats = mqtt_client.publish_many(((pub_topic, message) for pub_topic in pub_topic_list),
+                                              retain=retain, properties=properties)
+    failed = 0
+    for result in results:
+        # paho sends a queued message itself after reconnecting; a daemon
+        # publishing it again would only add a duplicate
+        if result["acked"] or (result["queued"] and not wait):
+            continue
+        logger.error(f"Publish to {result['topic']} was not acknowledged (rc: {result['rc']})")
+        failed += 1
+    return failed == 0
+
+def run_daemon(mqtt_client, logger, config, ifname, pub_topic_list, codec):
+    """
+    Keeps the connection open and publishes (retained) whenever the addresses
+    of the interfaces matching 'ifname' change, plus every 'heartbeat_s'
+    seconds if configured. Address changes come from netlink;
+    'poll_interval_s' is the fallback re-check interval, and the only one
+    where netlink is unavailable.
+    """
+    poll_interval_s = config["poll_interval_s"] if "poll_interval_s" in config else 30
+    heartbeat_s     = config["heartbeat_s"] if "heartbeat_s" in config else 0
+    retain          = config["retain"] if "retain" in config else True
+
+    done = False
+    def stop_handler(signum, frame):
+        nonlocal done
+        logger.info("Shutting down...")
+        done = True
+    signal.signal(signal.SIGINT, stop_handler)
+    signal.signal(signal.SIGTERM, stop_handler)
+
+    addr_watch = open_addr_watch()
+    if addr_watch == None:
+        logger.info(f"  netlink not available, polling {ifname} every {poll_interval_s}s")
+
+    last_interfaces = None
+    last_publish = None
+    next_poll = 0
+    changed = True
+    while not done:
+        now = time.monotonic()
+        heartbeat_due = heartbeat_s > 0 and last_publish != None and now - last_publish >= heartbeat_s
+        if changed or now >= next_poll or heartbeat_due:
+            next_poll = now + poll_interval_s
+            interfaces = get_ip_addresses(ifname)
+
+            if mqtt_client.outbox == None and not mqtt_client.connected:
+                # publishing now would only pile up messages in paho's queue;
+                # check again in a second
+                next_poll = now + 1.0
+            elif interfaces and (interfaces != last_interfaces or heartbeat_due):
+                if interfaces != last_interfaces:
+                    logger.info(f"IP addresses of {ifname} are {interfaces}")
+                message = create_message(interfaces, codec)
+                logger.info(f"Message to publish: {describe_message(message, codec)}")
+                if publish_message(mqtt_client, logger, pub_topic_list, message, retain, codec, wait=False):
+                    last_interfaces = interfaces
+                last_publish = now
+
+        # wake up at least once a second so a signal is noticed promptly
+        changed = wait_for_addr_change(addr_watch, min(1.0, max(0.0, next_poll - time.monotonic())))
+
+    if addr_watch != None:
+        addr_watch.close()
+
+def run(config, logger, daemon=False):
+    """
+    Publishes the addresses once, or with 'daemon' keeps publishing them
+    whenever they change. 'config' must already be validated (see
+    mqtt_config); paho and ssl are only imported from here on.
+    """
+    from mqtt_publisher import MqttPublisher
+
     ifname = config["ifname"]
     pub_topic_list = config["topic_list"]
-    
-    fileHandler = logging.FileHandler(log_file_name)
-    fileHandler.setFormatter(logFormatter)
-    logger.addHandler(fileHandler)
+    # "json" (default), "msgpack" or "struct", see mqtt_codec
+    try:
+        codec = get_codec(config["payload_codec"] if "payload_codec" in config else "json")
+    except ValueError as e:
+        logger.error(str(e))
+        return False
 
     logger.info("*** Starting IP Address Publisher Utility. ***")
-    logger.info(f"  Looking for IP adress for this interface: {ifname}")
+    logger.info(f"  Looking for IP adresses for these interfaces: {ifname}")
     logger.info(f"  Publishing to this topic list: {pub_topic_list}\n")
 
-    ip_address = get_ip_address(ifname)
-    logger.info(f"IP address of {ifname} is {ip_address}")
+    daemon = daemon or ("daemon" in config and config["daemon"])
+    if not daemon:
+        interfaces = get_ip_addresses(ifname)
+        if not interfaces:
+            logger.error(f"No interface matching {ifname} has an address")
+            return False
+        logger.info(f"IP addresses of {ifname} are {interfaces}")
     
     logger.info("Creating MQTT Publisher")
-    mqtt_client = MqttPublisher(config, logger)
+    metrics = MetricsRegistry()
+    mqtt_client = MqttPublisher(config, logger, metrics=metrics)
+    metrics_server = None
+    if daemon and "metrics_port" in config and config["metrics_port"] != None:
+        metrics_server = serve_metrics(metrics, "0.0.0.0", config["metrics_port"])
 
     logger.info("Setting up and connecting")
     mqtt_client.setup()
-    mqtt_client.connect()
+    # a daemon started before the broker (or the network) is up keeps retrying
+    mqtt_client.connect(retry=daemon)
     logger.info("Starting process loop...")
     mqtt_client.start()
 
-    message = json.dumps({"timestamp": f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-                          "ip_address":ip_address})
-    logger.info(f"Message to publish: {message}")
-    
-    for pub_topic in pub_topic_list:
-        logger.info(f"Publishing to topic: {pub_topic}")
-        mqtt_client.publish(pub_topic, message)
+    published = True
+    if daemon:
+        logger.info("Running as a daemon")
+        run_daemon(mqtt_client, logger, config, ifname, pub_topic_list, codec)
+    else:
+        message = create_message(interfaces, codec)
+        logger.info(f"Message to publish: {describe_message(message, codec)}")
+        retain = config["retain"] if "retain" in config else False
+        published = publish_message(mqtt_client, logger, pub_topic_list, message, retain, codec)
     
-    mqtt_client.stop()
     mqtt_client.disconnect()
+    mqtt_client.stop()
+    if metrics_server != None:
+        metrics_server.shutdown()
+    return published
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MQTT Client')
+    parser.add_argument('-c', '--config_file_path', action="store", default='mqtt_client_config.json', help='path to config file')
+    parser.add_argument('-d', '--daemon', action="store_true", help='stay connected and publish whenever the address changes')
+    args = parser.parse_args(argv)
+
+    logger, console_handler = create_logger("mqtt_client")
+    try:
+        config = load_config(args.config_file_path, "publisher", logger)
+    except ConfigError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+    # console and file writes happen on a listener thread, not in the MQTT callbacks
+    log_listener = start_logging(logger, console_handler, config, "ip_publisher.log")
+    try:
+        published = run(config, logger, args.daemon)
+    finally:
+        log_listener.stop()
+    if not published:
+        sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
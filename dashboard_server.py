@@ -0,0 +1,237 @@
+import gzip
+import hashlib
+import json
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock, Condition
+
+class Page(object):
+    """
+    One rendered response body, with its gzip form and ETag computed once
+    at update time rather than per request.
+    """
+    __slots__ = ("body", "gzipped", "etag", "content_type")
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=6)
+        self.etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        self.content_type = content_type
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match is "*" or a comma separated list of strong or weak (W/)
+    # tags; weak comparison is what a GET revalidation uses
+    if if_none_match == None:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == etag:
+            return True
+    return False
+
+def accepts_gzip(accept_encoding):
+    # True unless Accept-Encoding leaves gzip out or gives it q=0, either by
+    # name or through "*"
+    qvalues = {}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    if "gzip" in qvalues:
+        return qvalues["gzip"] > 0
+    return qvalues.get("*", 0) > 0
+
+class DashboardRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        self.server.dashboard.logger.debug("[http] " + (format % args))
+
+    def do_GET(self):
+        dashboard = self.server.dashboard
+        url = urlsplit(self.path)
+        path = url.path
+        query = parse_qs(url.query)
+        if path in ("/", "/index.html"):
+            self.send_page(dashboard.get_page("html"))
+        elif path == "/api/hosts" and dashboard.hosts_page != None and ("offset" in query or "limit" in query):
+            self.send_hosts_page(dashboard, query)
+        elif path == "/api/hosts":
+            self.send_page(dashboard.get_page("json"))
+        elif path == "/events":
+            self.send_events(dashboard)
+        elif path == "/metrics" and dashboard.metrics != None:
+            self.send_metrics(dashboard.metrics)
+        else:
+            self.send_error(404)
+
+    def send_page(self, page):
+        if page == None:
+            self.send_error(503, "Nothing rendered yet")
+            return
+        if etag_matches(self.headers.get("If-None-Match"), page.etag):
+            self.send_response(304)
+            self.send_header("ETag", page.etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = page.body
+        self.send_response(200)
+        if accepts_gzip(self.headers.get("Accept-Encoding")):
+            body = page.gzipped
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", page.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", page.etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_hosts_page(self, dashboard, query):
+        # one page of a larger host list, built per request
+        try:
+            offset = max(0, int(query.get("offset", ["0"])[0]))
+            limit = min(max(1, int(query.get("limit", ["100"])[0])), 1000)
+        except ValueError:
+            self.send_error(400, "offset and limit must be integers")
+            return
+        self.send_page(Page(json.dumps(dashboard.hosts_page(offset, limit), separators=(",", ":")).encode("UTF-8"),
+                            "application/json"))
+
+    def send_metrics(self, metrics):
+        body = metrics.render().encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, dashboard):
+        # Server-Sent Events: push the JSON view every time it changes. Each
+        # stream holds a server thread, so only max_streams run at once
+        if not dashboard.open_stream():
+            self.send_response(503)
+            self.send_header("Retry-After", "30")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        try:
+            self.stream_events(dashboard)
+        finally:
+            dashboard.close_stream()
+
+    def stream_events(self, dashboard):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        generation = -1
+        try:
+            while True:
+                page, generation = dashboard.wait_for_update(generation, timeout=15)
+                if dashboard.stopping:
+                    break
+                if page == None:
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    self.wfile.write(b"data: " + page.body + b"\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+class DashboardServer(object):
+    """
+    Embedded HTTP server for the IP dashboard. Serves the last rendered page
+    from memory on / (with ETag/If-None-Match and gzip), the same data as
+    JSON on /api/hosts, and a Server-Sent Events stream of updates on
+    /events (at most 'max_streams' at a time, each holds a server thread).
+    With a MetricsRegistry it also serves /metrics, and with a
+    'hosts_page' function, called as hosts_page(offset, limit) and returning
+    JSON-serializable data, /api/hosts?offset=&limit= pages through the full
+    host list. Requests are handled on the server's own threads, so update()
+    never blocks on a slow client.
+    """
+
+    def __init__(self, host, port, logger, metrics=None, hosts_page=None, max_streams=32):
+        self.logger = logger
+        self.metrics = metrics
+        self.hosts_page = hosts_page
+        self.host = host
+        self.port = port
+        self.pages = {}
+        self.generation = 0
+        self.stopping = False
+        self.max_streams = max_streams
+        self.streams = 0
+        self.update_cond = Condition(Lock())
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), DashboardRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.dashboard = self
+        self.thread = Thread(target=self.httpd.serve_forever, name="DashboardServer", daemon=True)
+        self.thread.start()
+        self.logger.info(f"Serving dashboard on http://{self.host}:{self.port}/")
+
+    def stop(self):
+        with self.update_cond:
+            self.stopping = True
+            self.update_cond.notify_all()
+        if self.httpd != None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def update(self, html, data):
+        # html is the page text, data any JSON-serializable object
+        pages = {"html": Page(html.encode("UTF-8"), "text/html; charset=utf-8"),
+                 "json": Page(json.dumps(data, separators=(",", ":")).encode("UTF-8"),
+                              "application/json")}
+        with self.update_cond:
+            self.pages.update(pages)
+            self.generation += 1
+            self.update_cond.notify_all()
+
+    def open_stream(self):
+        # False when max_streams event streams are already open
+        with self.update_cond:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self.update_cond:
+            self.streams -= 1
+
+    def get_page(self, name):
+        with self.update_cond:
+            return self.pages.get(name)
+
+    def wait_for_update(self, generation, timeout=None):
+        """
+        Returns (json page, generation) once the data is newer than
+        'generation', or (None, generation) if 'timeout' passes first.
+        """
+        with self.update_cond:
+            updated = self.update_cond.wait_for(
+                lambda: self.stopping or (self.generation > generation and "json" in self.pages), timeout)
+            if not updated or self.stopping:
+                return None, generation
+            return self.pages["json"], self.generation
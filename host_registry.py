@@ -0,0 +1,174 @@
+import time
+import heapq
+from datetime import datetime
+from threading import Lock
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class HostEntry(object):
+    """
+    Latest known state of one host topic. last_seen is the publisher's own
+    timestamp when the payload has one (a retained message can be weeks
+    old when it is received), otherwise the receive time.
+    """
+    __slots__ = ("topic", "ip_address", "payload", "published", "received", "last_seen", "expires_at")
+
+    def __init__(self, topic, ip_address, payload, published, received, expires_at):
+        self.topic = topic
+        self.ip_address = ip_address
+        self.payload = payload
+        self.published = published
+        self.received = received
+        self.last_seen = published if published != None else received
+        self.expires_at = expires_at
+
+    def age_s(self, now=None):
+        return (time.time() if now == None else now) - self.last_seen
+
+def parse_host_payload(record):
+    """
+    Returns (ip_address, published epoch time or None) from an
+    IP_address_publisher message, in any of the mqtt_codec formats.
+    Payloads that are not JSON (eg. from publish_ip.py) are taken to be the
+    address itself.
+    """
+    try:
+        data = record.json()
+    except ValueError:
+        return record.text().strip(), None
+    if not isinstance(data, dict):
+        return str(data), None
+    published = None
+    timestamp_ms = data.get("timestamp_ms")
+    if isinstance(timestamp_ms, (int, float)) and not isinstance(timestamp_ms, bool):
+        published = timestamp_ms / 1000
+    elif "timestamp" in data:
+        # publishers from before timestamp_ms only send their local time,
+        # which is only right here if both ends share a time zone; a
+        # timestamp that carries its UTC offset is read with it
+        for timestamp_format in (TIMESTAMP_FORMAT + "%z", TIMESTAMP_FORMAT):
+            try:
+                published = datetime.strptime(data["timestamp"], timestamp_format).timestamp()
+                break
+            except (TypeError, ValueError):
+                pass
+    return data.get("ip_address"), published
+
+class HostRegistry(object):
+    """
+    Hosts keyed by topic, each expiring 'ttl_s' after it was last seen.
+    Expiry times sit in a min-heap, so expire() only touches the entries
+    that are due (O(log n) each) instead of scanning every host; heap items
+    left behind by an update are skipped when they surface. page() sorts
+    the topics when hosts were added or removed since the last page, so
+    updates stay O(log n). With more than 'max_hosts' hosts the ones due to
+    expire first are dropped. Hosts not seen for 'stale_after_s' are
+    reported as stale but kept until they expire. 'on_remove', if given, is
+    called with the topic of every host that expires or is dropped.
+    """
+
+    def __init__(self, ttl_s=7 * 24 * 3600, stale_after_s=3600, max_hosts=100000, on_remove=None):
+        self.ttl_s = ttl_s
+        self.stale_after_s = stale_after_s
+        self.max_hosts = max_hosts
+        self.hosts = {}
+        self.topics = None          # sorted hosts keys, None when out of date
+        self.expiry_heap = []       # (expires_at, topic)
+        self.expired_count = 0
+        self.generation = 0
+        self.on_remove = on_remove
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def update(self, record):
+        """
+        Adds or refreshes the host for an MqttRecord. Returns True when the
+        host was added or its address changed.
+        """
+        ip_address, published = parse_host_payload(record)
+        entry = HostEntry(record.topic, ip_address, record.text(), published, record.timestamp, 0)
+        entry.expires_at = entry.last_seen + self.ttl_s
+        removed = []
+        with self.lock:
+            previous = self.hosts.get(record.topic)
+            if previous == None:
+                self.topics = None
+            self.hosts[record.topic] = entry
+            heapq.heappush(self.expiry_heap, (entry.expires_at, record.topic))
+            while len(self.hosts) > self.max_hosts:
+                topic = self._pop_expiry()
+                if topic != None:
+                    removed.append(topic)
+            self._compact_heap()
+            self.generation += 1
+        self._removed(removed)
+        return previous == None or previous.ip_address != ip_address
+
+    def expire(self, now=None):
+        # drops every host past its expiry time and returns how many went
+        now = time.time() if now == None else now
+        removed = []
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                topic = self._pop_expiry()
+                if topic != None:
+                    removed.append(topic)
+            if removed:
+                self.expired_count += len(removed)
+                self.generation += 1
+        self._removed(removed)
+        return len(removed)
+
+    def _pop_expiry(self):
+        # removes the heap's first item, and its host if the item is current,
+        # returning the host's topic or None; called with lock held
+        expires_at, topic = heapq.heappop(self.expiry_heap)
+        entry = self.hosts.get(topic)
+        if entry == None or entry.expires_at != expires_at:
+            return None
+        del self.hosts[topic]
+        self.topics = None
+        return topic
+
+    def _removed(self, topics):
+        # called without the lock, so on_remove may take its own locks
+        if self.on_remove != None:
+            for topic in topics:
+                self.on_remove(topic)
+
+    def _compact_heap(self):
+        # hosts that republish leave old heap items behind; rebuild once
+        # they outnumber the live ones so memory stays bounded
+        if len(self.expiry_heap) > 2 * len(self.hosts) + 64:
+            self.expiry_heap = [(entry.expires_at, topic) for topic, entry in self.hosts.items()]
+            heapq.heapify(self.expiry_heap)
+
+    def next_expiry(self):
+        # earliest time expire() has something to do, or None
+        with self.lock:
+            return self.expiry_heap[0][0] if self.expiry_heap else None
+
+    def is_stale(self, entry, now=None):
+        return entry.age_s(now) > self.stale_after_s
+
+    def page(self, offset=0, limit=100):
+        """
+        Returns (entries, total) for up to 'limit' hosts in topic order,
+        starting at 'offset'.
+        """
+        with self.lock:
+            if self.topics == None:
+                self.topics = sorted(self.hosts)
+            topics = self.topics[offset:offset + limit]
+            return [self.hosts[topic] for topic in topics], len(self.topics)
+
+    def get_stats(self, now=None):
+        now = time.time() if now == None else now
+        with self.lock:
+            stale = sum(1 for entry in self.hosts.values() if entry.age_s(now) > self.stale_after_s)
+            return {"hosts": len(self.hosts),
+                    "stale": stale,
+                    "expired": self.expired_count,
+                    "heap_size": len(self.expiry_heap)}
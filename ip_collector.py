@@ -0,0 +1,108 @@
+import array
+import socket
+import fcntl
+import struct
+import fnmatch
+import ipaddress
+
+SIOCGIFCONF = 0x8912
+
+# netlink route protocol constants (linux/netlink.h, linux/rtnetlink.h)
+NLMSG_ERROR   = 2
+NLMSG_DONE    = 3
+RTM_NEWADDR   = 20
+RTM_GETADDR   = 22
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP    = 0x300
+IFA_ADDRESS   = 1
+IFA_LOCAL     = 2
+RT_SCOPE_LINK = 253
+
+NLMSG_HDR = struct.Struct("=IHHII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTATTR    = struct.Struct("=HH")
+
+def _align(length):
+    return (length + 3) & ~3
+
+def _netlink_addresses():
+    # one RTM_GETADDR dump returns every IPv4 and IPv6 address on the host
+    index_names = dict(socket.if_nameindex())
+    addresses = []
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as s:
+        s.bind((0, 0))
+        request = NLMSG_HDR.pack(NLMSG_HDR.size + IFADDRMSG.size, RTM_GETADDR,
+                                 NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        s.send(request)
+        while True:
+            data = s.recv(65536)
+            offset = 0
+            while offset + NLMSG_HDR.size <= len(data):
+                msg_len, msg_type, _, _, _ = NLMSG_HDR.unpack_from(data, offset)
+                if msg_type == NLMSG_DONE:
+                    return addresses
+                if msg_type == NLMSG_ERROR:
+                    raise OSError("netlink RTM_GETADDR dump failed")
+                if msg_type == RTM_NEWADDR:
+                    family, _, _, scope, index = IFADDRMSG.unpack_from(data, offset + NLMSG_HDR.size)
+                    attrs = {}
+                    attr_offset = offset + NLMSG_HDR.size + IFADDRMSG.size
+                    while attr_offset + RTATTR.size <= offset + msg_len:
+                        attr_len, attr_type = RTATTR.unpack_from(data, attr_offset)
+                        if attr_len < RTATTR.size:
+                            break
+                        attrs[attr_type] = data[attr_offset + RTATTR.size:attr_offset + attr_len]
+                        attr_offset += _align(attr_len)
+                    # IFA_LOCAL is the interface's own address on point-to-point links
+                    raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+                    if raw != None and not (family == socket.AF_INET6 and scope == RT_SCOPE_LINK):
+                        addresses.append((index_names.get(index, str(index)), family,
+                                          socket.inet_ntop(family, raw)))
+                offset += _align(msg_len)
+
+def _ioctl_addresses():
+    # fallback without netlink: SIOCGIFCONF lists the IPv4 interfaces in one call
+    ifreq_size = 40 if struct.calcsize("P") == 8 else 32
+    max_bytes = ifreq_size * 128
+    names = array.array("B", bytes(max_bytes))
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        address, _ = names.buffer_info()
+        out_len = struct.unpack("iL", fcntl.ioctl(s.fileno(), SIOCGIFCONF,
+                                                  struct.pack("iL", max_bytes, address)))[0]
+    data = names.tobytes()
+    addresses = []
+    for offset in range(0, out_len, ifreq_size):
+        ifname = data[offset:offset + 16].split(b"\0", 1)[0].decode("utf-8")
+        addresses.append((ifname, socket.AF_INET, socket.inet_ntoa(data[offset + 20:offset + 24])))
+    return addresses
+
+def get_ip_addresses(patterns=None):
+    """
+    Collects the addresses of every interface in one pass and returns
+    {ifname: {"ipv4": [...], "ipv6": [...]}} for the interfaces matching any
+    of the glob 'patterns' (a string or a list, eg "eth*" or ["en*", "wl*"]).
+    IPv6 link-local addresses are left out.
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    try:
+        addresses = _netlink_addresses()
+    except (AttributeError, OSError):
+        addresses = _ioctl_addresses()
+
+    interfaces = {}
+    for ifname, family, address in addresses:
+        if patterns and not any(fnmatch.fnmatchcase(ifname, pattern) for pattern in patterns):
+            continue
+        entry = interfaces.setdefault(ifname, {"ipv4": [], "ipv6": []})
+        entry["ipv4" if family == socket.AF_INET else "ipv6"].append(address)
+    return interfaces
+
+def primary_ipv4(interfaces):
+    # first non-loopback IPv4 address in interface name order, used as the
+    # "ip_address"; with a glob like "*" the lo interface would sort first
+    for ifname in sorted(interfaces):
+        for address in interfaces[ifname]["ipv4"]:
+            if not ipaddress.ip_address(address).is_loopback:
+                return address
+    return None
@@ -0,0 +1,273 @@
+import asyncio
+import itertools
+import struct
+from threading import Thread, Event
+
+# MQTT control packet types
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+MQTTv5 = 5
+
+def topic_matches(topic_filter, topic):
+    # MQTT filter matching with '+' (one level) and '#' (rest of the topic)
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    if topic.startswith("$") and filter_levels[0] in ("+", "#"):
+        return False
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value % 128
+        value //= 128
+        out.append(byte | 0x80 if value > 0 else byte)
+        if value == 0:
+            return bytes(out)
+
+def decode_varint(data, offset):
+    # returns (value, offset after the varint)
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+def subscription_identifier(properties):
+    # the Subscription Identifier in a SUBSCRIBE's properties, or None; the
+    # only other property allowed there is User Property (two strings)
+    offset = 0
+    while offset < len(properties):
+        identifier = properties[offset]
+        offset += 1
+        if identifier == 0x0B:
+            return decode_varint(properties, offset)[0]
+        for _ in range(2):
+            length = struct.unpack_from("!H", properties, offset)[0]
+            offset += 2 + length
+    return None
+
+def encode_str(value):
+    raw = value.encode("UTF-8")
+    return struct.pack("!H", len(raw)) + raw
+
+def decode_str(data, offset):
+    length = struct.unpack_from("!H", data, offset)[0]
+    return bytes(data[offset + 2:offset + 2 + length]).decode("UTF-8"), offset + 2 + length
+
+def packet(packet_type, body, flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_varint(len(body)) + body
+
+class Session(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = None
+        self.protocol = MQTTv5
+        # filter as subscribed -> (qos, share group or None, filter without
+        # the $share prefix, subscription identifier or None)
+        self.subscriptions = {}
+        self.packet_ids = itertools.cycle(range(1, 65536))
+
+class LocalBroker(object):
+    """
+    Minimal in-process MQTT 3.1.1/5 broker for benchmarks and local testing.
+    Supports QoS 0-2 from publishers (delivered at up to QoS 1), retained
+    messages, wildcards, $share/<group>/ shared subscriptions and MQTT v5
+    subscription identifiers. There is
+    no authentication, persistence or session resumption.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, ssl_context=None, logger=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.logger = logger
+        self.sessions = set()
+        self.retained = {}          # topic -> (payload, qos, properties)
+        self.share_cursor = {}      # (group, filter) -> round robin position
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.ready = Event()
+
+    def start(self):
+        self.thread = Thread(target=self._run, name="LocalBroker", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread != None:
+            self.thread.join()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port, ssl=self.ssl_context))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            for session in list(self.sessions):
+                session.writer.close()
+            self.loop.close()
+
+    async def _handle(self, reader, writer):
+        session = Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length > 0 else b""
+                if not self._dispatch(session, first[0] >> 4, first[0] & 0x0F, body):
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    def _dispatch(self, session, packet_type, flags, body):
+        v5 = session.protocol == MQTTv5
+        if packet_type == CONNECT:
+            _, offset = decode_str(body, 0)
+            session.protocol = body[offset]
+            offset += 4     # level, flags, keepalive
+            if session.protocol == MQTTv5:
+                props_len, offset = decode_varint(body, offset)
+                offset += props_len
+            session.client_id, offset = decode_str(body, offset)
+            session.writer.write(packet(CONNACK, b"\x00\x00\x00" if session.protocol == MQTTv5 else b"\x00\x00"))
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 3
+            retain = flags & 1
+            topic, offset = decode_str(body, 0)
+            if qos > 0:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+            properties = b""
+            if v5:
+                props_len, props_start = decode_varint(body, offset)
+                properties = body[props_start:props_start + props_len]
+                offset = props_start + props_len
+            payload = body[offset:]
+            if qos == 1:
+                session.writer.write(packet(PUBACK, packet_id))
+            elif qos == 2:
+                session.writer.write(packet(PUBREC, packet_id))
+            if retain:
+                if payload:
+                    self.retained[topic] = (payload, qos, properties)
+                else:
+                    self.retained.pop(topic, None)
+            self._deliver(topic, payload, qos, properties)
+        elif packet_type == PUBREL:
+            session.writer.write(packet(PUBCOMP, body[:2]))
+        elif packet_type == SUBSCRIBE:
+            packet_id = body[:2]
+            offset = 2
+            sub_id = None
+            if v5:
+                props_len, offset = decode_varint(body, offset)
+                sub_id = subscription_identifier(body[offset:offset + props_len])
+                offset += props_len
+            codes = bytearray()
+            new_filters = []
+            while offset < len(body):
+                subscribed, offset = decode_str(body, offset)
+                qos = min(body[offset] & 3, 1)
+                offset += 1
+                group = None
+                topic_filter = subscribed
+                if topic_filter.startswith("$share/"):
+                    _, group, topic_filter = topic_filter.split("/", 2)
+                session.subscriptions[subscribed] = (qos, group, topic_filter, sub_id)
+                new_filters.append((topic_filter, qos, group))
+                codes.append(qos)
+            session.writer.write(packet(SUBACK, packet_id + (b"\x00" if v5 else b"") + bytes(codes)))
+            for topic_filter, qos, group in new_filters:
+                if group == None:
+                    self._send_retained(session, topic_filter, qos, sub_id)
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = body[:2]
+            offset = 2
+            if v5:
+                props_len, offset = decode_varint(body, offset)
+                offset += props_len
+            count = 0
+            while offset < len(body):
+                topic_filter, offset = decode_str(body, offset)
+                session.subscriptions.pop(topic_filter, None)
+                count += 1
+            session.writer.write(packet(UNSUBACK, packet_id + (b"\x00" + b"\x00" * count if v5 else b"")))
+        elif packet_type == PINGREQ:
+            session.writer.write(packet(PINGRESP, b""))
+        elif packet_type == DISCONNECT:
+            return False
+        # PUBACK/PUBREC/PUBCOMP from subscribers need no action here
+        return True
+
+    def _send(self, session, topic, payload, qos, properties, retain=False, sub_ids=()):
+        body = encode_str(topic)
+        if qos > 0:
+            body += struct.pack("!H", next(session.packet_ids))
+        if session.protocol == MQTTv5:
+            properties += b"".join(b"\x0b" + encode_varint(sub_id) for sub_id in sub_ids)
+            body += encode_varint(len(properties)) + properties
+        session.writer.write(packet(PUBLISH, body + payload, flags=qos << 1 | (1 if retain else 0)))
+
+    def _send_retained(self, session, topic_filter, sub_qos, sub_id=None):
+        for topic, (payload, qos, properties) in self.retained.items():
+            if topic_matches(topic_filter, topic):
+                self._send(session, topic, payload, min(qos, sub_qos), properties, retain=True,
+                           sub_ids=(sub_id,) if sub_id != None else ())
+
+    def _deliver(self, topic, payload, qos, properties):
+        shared = {}     # (group, filter) -> [(session, qos, subscription identifier)]
+        for session in self.sessions:
+            # overlapping plain subscriptions get one copy carrying all
+            # their subscription identifiers
+            best = None
+            sub_ids = []
+            for sub_qos, group, topic_filter, sub_id in session.subscriptions.values():
+                if not topic_matches(topic_filter, topic):
+                    continue
+                if group != None:
+                    shared.setdefault((group, topic_filter), []).append((session, sub_qos, sub_id))
+                    continue
+                if best == None or sub_qos > best:
+                    best = sub_qos
+                if sub_id != None:
+                    sub_ids.append(sub_id)
+            if best != None:
+                self._send(session, topic, payload, min(qos, best), properties, sub_ids=sub_ids)
+        # each shared subscription group gets one copy, round robin
+        for key, members in shared.items():
+            position = self.share_cursor.get(key, 0)
+            session, sub_qos, sub_id = members[position % len(members)]
+            self.share_cursor[key] = position + 1
+            self._send(session, topic, payload, min(qos, sub_qos), properties,
+                       sub_ids=(sub_id,) if sub_id != None else ())
@@ -0,0 +1,388 @@
+import asyncio
+import random
+from threading import Thread
+
+import paho.mqtt.client as mqtt
+
+from mqtt_tls import ConnectTimer
+
+class LoopThread(object):
+    """
+    An event loop run by a daemon thread. The sync MqttClient and
+    MqttPublisher each drive their AsyncMqttClient on one, in place of the
+    thread loop_start() would start.
+    """
+
+    def __init__(self, name):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+class AsyncMqttClient(object):
+    """
+    asyncio MQTT client that can both subscribe and publish. The paho client
+    is driven from the event loop through its socket callbacks instead of a
+    loop_start() thread, so one process can hold many broker connections.
+    Once connected, a dropped connection is re-established in the background
+    with exponential backoff (reconnect_min_delay_s up to
+    reconnect_max_delay_s, with jitter), and whatever was waiting on the old
+    connection fails with ConnectionError.
+
+    'listener' is how the sync MqttClient and MqttPublisher wrap this client
+    on a LoopThread: it gets the paho callbacks (on_connect, on_message,
+    ...) instead of this client logging them, queueing messages and
+    subscribing to topic_list.
+    """
+
+    def __init__(self, config, logger, loop=None, listener=None):
+        self.logger = logger
+        self.config = config
+        self.loop = loop
+        self.listener = listener
+        self.mqttc = None
+
+        self.name = config["name"] if len(config["name"]) > 0 else "AsyncMqttClient"
+
+        # TLS setup and connect latency of the last (re)connect
+        self.connect_timer = ConnectTimer(config, logger)
+        self.connect_timeout_s = config["connect_timeout_s"] if "connect_timeout_s" in config else 30
+
+        # reconnect backoff; stopping is set by disconnect() and close(), and
+        # auto_reconnect once a connection was accepted (or connect() retries)
+        self.reconnect_min_delay_s = config["reconnect_min_delay_s"] if "reconnect_min_delay_s" in config else 1
+        self.reconnect_max_delay_s = config["reconnect_max_delay_s"] if "reconnect_max_delay_s" in config else 120
+        self.reconnect_attempt = 0
+        self.stopping = False
+        self.auto_reconnect = False
+
+        self.topics = list(config["topic_list"]) if "topic_list" in config else []
+        # incoming messages; when full the oldest message is dropped
+        queue_size = config["msg_queue_size"] if "msg_queue_size" in config else 1000
+        self.msg_queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped_msgs = 0
+
+        self._connected = None
+        self._disconnected = None
+        self._pending = {}   # mid -> future, for SUBACK/PUBACK
+        self._misc_task = None
+        self._reconnect_task = None
+
+    # ---- paho socket callbacks, these hook the socket into the event loop
+    def _in_loop(self, func, *args):
+        # on_socket_open fires in the executor thread running connect(), and
+        # the sync wrappers publish from their own threads. Once the loop is
+        # closed (eg. at interpreter shutdown) there is nothing left to drive.
+        if self.loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _on_readable(self):
+        self.mqttc.loop_read()
+        # TLS may already have decrypted data buffered that select won't see
+        sock = self.mqttc.socket()
+        while sock != None and hasattr(sock, "pending") and sock.pending() > 0:
+            self.mqttc.loop_read()
+            sock = self.mqttc.socket()
+
+    def _add_reader(self, sock):
+        self.loop.add_reader(sock, self._on_readable)
+        if self._misc_task == None:
+            self._misc_task = self.loop.create_task(self._misc_loop())
+
+    def _remove_reader(self, sock):
+        self.loop.remove_reader(sock)
+        if self._misc_task != None:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    def on_socket_open(self, client, userdata, sock):
+        self._in_loop(self._add_reader, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._in_loop(self._remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_writer, sock)
+
+    async def _misc_loop(self):
+        # keepalive pings, normally done by loop_start(). A missed ping
+        # closes the socket and on_disconnect schedules the reconnect; this
+        # only ends without one if paho lost the socket some other way.
+        try:
+            while self.mqttc.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            return
+        self._misc_task = None
+        self._schedule_reconnect()
+
+    # ---- reconnecting, normally done by loop_start()
+    def next_reconnect_delay(self):
+        # exponential backoff with jitter, so a fleet of clients dropped at
+        # the same moment does not reconnect at the same moment
+        cap = min(self.reconnect_max_delay_s, self.reconnect_min_delay_s * 2 ** self.reconnect_attempt)
+        delay = random.uniform(self.reconnect_min_delay_s, max(cap, self.reconnect_min_delay_s))
+        self.reconnect_attempt += 1
+        self.logger.info(f"[reconnect] attempt {self.reconnect_attempt} in {delay:.1f}s")
+        return delay
+
+    def _schedule_reconnect(self):
+        if self.stopping or not self.auto_reconnect or self.loop.is_closed():
+            return
+        if self._reconnect_task == None or self._reconnect_task.done():
+            self._reconnect_task = self.loop.create_task(self._reconnect(self.next_reconnect_delay()))
+
+    def _cancel_reconnect(self):
+        if self._reconnect_task != None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+
+    async def _reconnect(self, delay):
+        # retries until the broker takes the connection; its CONNACK, or a
+        # refusal and the drop that schedules the next round, come in
+        # through the socket callbacks
+        while True:
+            await asyncio.sleep(delay)
+            if self.stopping:
+                return
+            try:
+                # DNS, TCP connect and the TLS handshake block, so keep them off the loop
+                await self.loop.run_in_executor(None, self.mqttc.reconnect)
+            except OSError as e:
+                self.logger.info(f"[reconnect] connection attempt failed: {e}")
+                on_connect_fail = getattr(self.listener, "on_connect_fail", None)
+                if on_connect_fail != None:
+                    on_connect_fail(self.mqttc, None)
+                delay = self.next_reconnect_delay()
+                continue
+            if self.stopping:
+                # disconnect() came in while the attempt was under way
+                self.mqttc.disconnect()
+            return
+
+    def _fail_waiters(self, error):
+        # whatever waits on the connection fails now rather than hanging
+        # until (or past) the next one
+        waiters = list(self._pending.values())
+        self._pending.clear()
+        if self._connected != None:
+            waiters.append(self._connected)
+        for future in waiters:
+            if not future.done():
+                future.set_exception(error)
+
+    def _connection_lost(self, rc):
+        self._fail_waiters(ConnectionError(f"disconnected: {rc}"))
+        if self._disconnected != None and not self._disconnected.done():
+            self._disconnected.set_result(rc)
+        self._schedule_reconnect()
+
+    # ---- MQTT callbacks, all of these run on the event loop
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if self.listener != None:
+            self.listener.on_connect(client, userdata, flags, rc, properties)
+        else:
+            self.logger.info(f"[on_connect] CONNACK received with code {rc}")
+            self.connect_timer.connected(client)
+            if properties != None:
+                self.logger.info(f"[on_connect] props: {properties}")
+        if not rc.is_failure:
+            self.reconnect_attempt = 0
+            self.auto_reconnect = True
+        if self._connected != None and not self._connected.done():
+            if rc.is_failure:
+                self._connected.set_exception(ConnectionError(f"connect failed: {rc}"))
+            else:
+                self._connected.set_result(rc)
+
+        if self.listener == None:
+            qos = self.config["subscribe_qos"] if "subscribe_qos" in self.config else 1
+            for topic in self.topics:
+                self.logger.info(f"[on_connect] subscribing to topic: {topic}")
+                client.subscribe(topic, qos=qos)
+
+    def on_disconnect(self, client, userdata, flags, rc, properties=None):
+        if self.listener != None:
+            self.listener.on_disconnect(client, userdata, flags, rc, properties)
+        else:
+            self.logger.info(f"[on_disconnect] reason_code: {rc}")
+        self._in_loop(self._connection_lost, rc)
+
+    def on_subscribe(self, client, userdata, mid, reason_code_list, properties=None):
+        if self.listener != None:
+            self.listener.on_subscribe(client, userdata, mid, reason_code_list, properties)
+        else:
+            self.logger.info(f"[on_subscribe] Subscribed: {str(mid)}, QOS: {str(reason_code_list)}")
+        self._resolve(mid, reason_code_list)
+
+    def on_unsubscribe(self, client, userdata, mid, reason_code_list, properties=None):
+        if self.listener != None:
+            self.listener.on_unsubscribe(client, userdata, mid, reason_code_list, properties)
+        else:
+            self.logger.info(f"[on_unsubscribe] Unsubscribed: {str(mid)}")
+        self._resolve(mid, reason_code_list)
+
+    def on_publish(self, client, userdata, mid, reason_code, properties=None):
+        if self.listener != None:
+            self.listener.on_publish(client, userdata, mid, reason_code, properties)
+        else:
+            self.logger.debug(f"[on_publish] Mid: {str(mid)}, reason_code: {reason_code}")
+        self._resolve(mid, reason_code)
+
+    def on_message(self, client, userdata, msg):
+        if self.listener != None:
+            self.listener.on_message(client, userdata, msg)
+            return
+        self.logger.debug("[on_message] " + msg.topic + " " + str(msg.qos))
+        if self.msg_queue.full():
+            self.msg_queue.get_nowait()
+            self.dropped_msgs += 1
+        self.msg_queue.put_nowait(msg)
+
+    def _resolve(self, mid, result):
+        future = self._pending.pop(mid, None)
+        if future != None and not future.done():
+            future.set_result(result)
+
+    def _wait_for_mid(self, mid):
+        future = self.loop.create_future()
+        self._pending[mid] = future
+        return future
+
+    # ---- public API
+    def setup(self, loop=None):
+        if loop != None:
+            self.loop = loop
+        if self.loop == None:
+            self.loop = asyncio.get_running_loop()
+
+        self.mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                                  client_id=self.config["client_id"],
+                                  userdata=None, protocol=mqtt.MQTTv5)
+        self.mqttc.enable_logger(self.logger)
+
+        self.mqttc.on_socket_open             = self.on_socket_open
+        self.mqttc.on_socket_close            = self.on_socket_close
+        self.mqttc.on_socket_register_write   = self.on_socket_register_write
+        self.mqttc.on_socket_unregister_write = self.on_socket_unregister_write
+
+        self.mqttc.on_connect     = self.on_connect
+        self.mqttc.on_disconnect  = self.on_disconnect
+        self.mqttc.on_subscribe   = self.on_subscribe
+        self.mqttc.on_unsubscribe = self.on_unsubscribe
+        self.mqttc.on_publish     = self.on_publish
+        self.mqttc.on_message     = self.on_message
+
+        # enable TLS for secure connection and time each connect
+        self.connect_timer.install(self.mqttc)
+        # set username and password
+        self.mqttc.username_pw_set(self.config["client_username"], self.config["client_pw"])
+
+    async def connect(self, timeout=None, retry=False):
+        """
+        Connects and waits for the CONNACK. Raises OSError if the broker
+        can't be reached and ConnectionError if it refuses; with 'retry'
+        both are retried with backoff until the broker accepts (or timeout,
+        after which the retries go on in the background).
+        """
+        if self.mqttc == None:
+            self.setup()
+        self.stopping = False
+        self.auto_reconnect = retry
+        self._cancel_reconnect()
+        clean_start = self.config["clean_start"] if "clean_start" in self.config else mqtt.MQTT_CLEAN_START_FIRST_ONLY
+        # only stores where to connect; reconnect() makes the connection
+        self.mqttc.connect_async(self.config["hivemq_url"], self.config["hivemq_port"], clean_start=clean_start)
+        deadline = self.loop.time() + timeout if timeout != None else None
+        self._connected = self.loop.create_future()
+        if retry:
+            self._reconnect_task = self.loop.create_task(self._reconnect(0))
+        else:
+            await self.loop.run_in_executor(None, self.mqttc.reconnect)
+        while True:
+            try:
+                return await asyncio.wait_for(self._connected,
+                                              max(0, deadline - self.loop.time()) if deadline != None else None)
+            except ConnectionError:
+                if not retry or self.stopping:
+                    raise
+                self._connected = self.loop.create_future()
+
+    async def subscribe(self, topic, qos=None, timeout=None):
+        if qos == None:
+            qos = self.config["subscribe_qos"] if "subscribe_qos" in self.config else 1
+        if topic not in self.topics:
+            self.topics.append(topic)
+        rc, mid = self.mqttc.subscribe(topic, qos=qos)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(f"subscribe to {topic} failed: {mqtt.error_string(rc)}")
+        return await asyncio.wait_for(self._wait_for_mid(mid), timeout)
+
+    async def publish(self, topic, message, qos=None, retain=False, timeout=None):
+        if qos == None:
+            qos = self.config["publish_qos"] if "publish_qos" in self.config else 1
+        info = self.mqttc.publish(topic, message, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(f"publish to {topic} failed: {mqtt.error_string(info.rc)}")
+        if qos == 0:
+            # QoS 0 has no acknowledgement, on_publish already fired
+            return info
+        await asyncio.wait_for(self._wait_for_mid(info.mid), timeout)
+        return info
+
+    async def messages(self):
+        """
+        Async iterator over incoming messages:
+            async for msg in client.messages(): ...
+        """
+        while True:
+            yield await self.msg_queue.get()
+
+    async def disconnect(self, timeout=None):
+        self.stopping = True
+        self._cancel_reconnect()
+        self._disconnected = self.loop.create_future()
+        if self.mqttc.disconnect() == mqtt.MQTT_ERR_NO_CONN:
+            # not connected (or still trying to), so no on_disconnect comes
+            self._disconnected.set_result(None)
+        try:
+            await asyncio.wait_for(self._disconnected, timeout)
+        finally:
+            self._fail_waiters(ConnectionError("disconnected"))
+
+    async def close(self):
+        """
+        Stops driving the connection without disconnecting, like
+        loop_stop(): no more reads, keepalives or reconnects.
+        """
+        self.stopping = True
+        self._cancel_reconnect()
+        sock = self.mqttc.socket() if self.mqttc != None else None
+        if sock != None:
+            self._remove_reader(sock)
+            self.loop.remove_writer(sock)
+        self._fail_waiters(ConnectionError("closed"))
+
+    def run_threadsafe(self, coro, wait=True):
+        """
+        Runs 'coro' on this client's loop from another thread, for the sync
+        wrappers. Waits for and returns its result, or without 'wait'
+        returns the concurrent.futures.Future.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return future.result() if wait else future
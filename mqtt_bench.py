@@ -0,0 +1,243 @@
+import os
+import sys
+import ssl
+import json
+import time
+import struct
+import shutil
+import socket
+import argparse
+import resource
+import subprocess
+import multiprocessing
+import logging
+from datetime import datetime
+from threading import Event
+
+from mqtt_client import MqttClient
+from mqtt_publisher import MqttPublisher
+from local_broker import LocalBroker
+
+# every payload starts with its send time so the subscriber can measure
+# end-to-end latency against the receive time of its record
+SEND_TIME = struct.Struct("<d")
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def rss_bytes():
+    # current resident set size (Linux), falling back to the peak
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def serve_local_broker(conn, tls_cert, tls_key):
+    """
+    Runs the local broker in a child process so its CPU time and memory
+    don't count towards the clients' figures. Sends the port, waits for a
+    stop request and answers with the broker's CPU seconds.
+    """
+    ssl_context = None
+    if tls_cert:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(tls_cert, tls_key)
+    broker = LocalBroker("127.0.0.1", 0, ssl_context=ssl_context)
+    broker.start()
+    conn.send(broker.port)
+    conn.recv()
+    broker.stop()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    conn.send(usage.ru_utime + usage.ru_stime)
+
+def start_broker(args, logger):
+    """
+    Starts the broker stand-in and returns (host, port, stop function).
+    The stop function returns the broker's CPU seconds when known.
+    """
+    if args.broker == "external":
+        return args.host, args.port, lambda: None
+
+    if args.broker == "mosquitto":
+        if shutil.which("mosquitto") == None:
+            logger.error("mosquitto not found on PATH")
+            sys.exit(1)
+        if args.tls_cert:
+            logger.error("TLS is only supported with the local broker")
+            sys.exit(1)
+        port = free_port()
+        proc = subprocess.Popen(["mosquitto", "-p", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(0.5)
+        def stop():
+            proc.terminate()
+            proc.wait()
+        return "127.0.0.1", port, stop
+
+    conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=serve_local_broker, args=(child_conn, args.tls_cert, args.tls_key), daemon=True)
+    proc.start()
+    if not conn.poll(10):
+        logger.error("local broker did not start")
+        proc.terminate()
+        sys.exit(1)
+    port = conn.recv()
+    def stop():
+        conn.send("stop")
+        cpu_s = conn.recv() if conn.poll(10) else None
+        proc.join(5)
+        return cpu_s
+    # connect by name so the certificate's hostname check can pass
+    return "localhost" if args.tls_cert else "127.0.0.1", port, stop
+
+def generate(args, topics, payload_pad):
+    # yields (topic, payload), throttled to args.rate msgs/s when set
+    start = time.monotonic()
+    for index in range(args.count):
+        if args.rate > 0:
+            delay = start + index / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield topics[index % len(topics)], SEND_TIME.pack(time.time()) + payload_pad
+
+def run(args, logger):
+    host, port, stop_broker = start_broker(args, logger)
+    base_config = {"name": "", "client_username": args.username, "client_pw": args.password,
+                   "hivemq_url": host, "hivemq_port": port, "clean_start": True,
+                   "use_tls": bool(args.tls_cert) or (args.broker == "external" and args.tls)}
+    if args.tls_cert:
+        # the benchmark certificate is self-signed, so trust it directly
+        base_config["tls_ca_file"] = args.tls_cert
+
+    sub_config = dict(base_config, client_id=f"bench-sub-{os.getpid()}", topic_list=["bench/#"],
+                      subscribe_qos=args.qos, msg_store_size=args.count, msg_log_rate=1)
+    pub_config = dict(base_config, client_id=f"bench-pub-{os.getpid()}", publish_qos=args.qos,
+                      max_inflight=args.max_inflight)
+
+    subscriber = MqttClient(sub_config, logger)
+    subscriber.setup()
+    subscribed = Event()
+    on_subscribe = subscriber.on_subscribe
+    def on_subscribe_and_signal(*cb_args):
+        on_subscribe(*cb_args)
+        subscribed.set()
+    subscriber.on_subscribe = on_subscribe_and_signal
+    subscriber.connect()
+    subscriber.start()
+    if not subscribed.wait(10):
+        logger.error("subscriber did not connect and subscribe")
+        stop_broker()
+        sys.exit(1)
+
+    publisher = MqttPublisher(pub_config, logger)
+    publisher.setup()
+    publisher.connect()
+    publisher.start()
+
+    topics = [f"bench/{index}" for index in range(args.topics)]
+    payload_pad = b"x" * max(0, args.payload_size - SEND_TIME.size)
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.monotonic()
+    results, pub_stats = publisher.publish_many(generate(args, topics, payload_pad))
+    deadline = time.monotonic() + args.timeout
+    while subscriber.msg_seq < args.count and time.monotonic() < deadline:
+        subscriber.wait_for_msgs(subscriber.msg_seq, timeout=0.5)
+    elapsed_s = time.monotonic() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    with subscriber.mutex:
+        records = list(subscriber.msg_store)
+        received = subscriber.msg_seq
+    latencies = [record.timestamp - SEND_TIME.unpack_from(record.payload)[0]
+                 for record in records if len(record.payload) >= SEND_TIME.size]
+    lost = max(0, args.count - received)
+
+    publisher.disconnect()
+    publisher.stop()
+    subscriber.disconnect()
+    subscriber.stop()
+    broker_cpu_s = stop_broker()
+
+    # this process only runs the publisher, the subscriber and the
+    # generator; the broker's own CPU time is reported separately
+    cpu_s = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    return {"sent": pub_stats["count"],
+            "acked": pub_stats["acked"],
+            "received": received,
+            "lost": lost,
+            "elapsed_s": elapsed_s,
+            "publish_msgs_per_s": pub_stats["msgs_per_s"],
+            "end_to_end_msgs_per_s": received / elapsed_s if elapsed_s > 0 else 0.0,
+            "ack_latency_avg_ms": pub_stats["ack_latency_avg_s"] * 1000 if pub_stats["ack_latency_avg_s"] != None else None,
+            "latency_p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+            "latency_p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+            "latency_max_ms": max(latencies) * 1000 if latencies else None,
+            "client_cpu_s": cpu_s,
+            "client_cpu_pct": 100 * cpu_s / elapsed_s if elapsed_s > 0 else 0.0,
+            "client_rss_bytes": rss_bytes(),
+            "client_max_rss_bytes": usage_end.ru_maxrss * 1024,
+            "broker_cpu_s": broker_cpu_s}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MQTT publisher/subscriber benchmark')
+    parser.add_argument('--broker', choices=["local", "mosquitto", "external"], default="local",
+                        help='local broker (in a child process), a mosquitto subprocess, or --host/--port')
+    parser.add_argument('--host', default="127.0.0.1", help='external broker host')
+    parser.add_argument('--port', type=int, default=1883, help='external broker port')
+    parser.add_argument('--tls', action="store_true", help='use TLS to the external broker')
+    parser.add_argument('--tls-cert', help='certificate for the local broker (enables TLS)')
+    parser.add_argument('--tls-key', help='private key for --tls-cert')
+    parser.add_argument('--username', default="bench")
+    parser.add_argument('--password', default="bench")
+    parser.add_argument('-n', '--count', type=int, default=10000, help='messages to publish')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='publish rate in msgs/s, 0 for as fast as possible')
+    parser.add_argument('-t', '--topics', type=int, default=100, help='number of distinct topics')
+    parser.add_argument('-s', '--payload-size', type=int, default=64, help='payload size in bytes')
+    parser.add_argument('-q', '--qos', type=int, choices=[0, 1, 2], default=1)
+    parser.add_argument('--max-inflight', type=int, default=100)
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for delivery')
+    parser.add_argument('-o', '--output', help='JSON results file (default bench_results/bench-<time>.json)')
+    args = parser.parse_args(argv)
+
+    logger = logging.getLogger("mqtt_bench")
+    logger.setLevel(logging.WARNING)
+    consoleHandler = logging.StreamHandler(sys.stdout)
+    consoleHandler.setFormatter(logging.Formatter("%(asctime)s [%(name)s] (%(levelname)s): %(message)s"))
+    logger.addHandler(consoleHandler)
+
+    results = run(args, logger)
+    report = {"timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              "git_commit": git_commit(),
+              "params": {key: value for key, value in vars(args).items() if key not in ("password", "output")},
+              "results": results}
+
+    output = args.output
+    if output == None:
+        output = os.path.join("bench_results", f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=4)
+
+    for key, value in results.items():
+        print(f"  {key:24} {value:.3f}" if isinstance(value, float) else f"  {key:24} {value}")
+    print(f"Results written to {output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import sys
+import argparse
+
+from mqtt_config import ConfigError, load_config, create_logger, start_logging
+
+def load_or_exit(path, schema_name, logger):
+    # validation happens before anything connects or imports paho
+    try:
+        return load_config(path, schema_name, logger)
+    except ConfigError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+def cmd_publish(args):
+    logger, console_handler = create_logger("mqtt_client")
+    config = load_or_exit(args.config_file_path, "publisher", logger)
+    if args.check:
+        logger.info(f"Config file {args.config_file_path} is valid")
+        return
+    log_listener = start_logging(logger, console_handler, config, "ip_publisher.log")
+    try:
+        import IP_address_publisher
+        published = IP_address_publisher.run(config, logger, args.daemon)
+    finally:
+        log_listener.stop()
+    if not published:
+        sys.exit(1)
+
+def cmd_subscribe(args):
+    logger, console_handler = create_logger("mqtt_client")
+    config = load_or_exit(args.config_file_path, "client", logger)
+    if args.command == "serve":
+        # serve the dashboard from memory rather than writing index.html
+        http_port = args.port if args.port != None else config.get("http_port")
+        config = dict(config, http_port=http_port if http_port != None else 8080)
+        if args.host != None:
+            config["http_host"] = args.host
+    if args.check:
+        logger.info(f"Config file {args.config_file_path} is valid")
+        return
+    log_listener = start_logging(logger, console_handler, config, "ip_client.log")
+    try:
+        import IP_address_client
+        IP_address_client.run(config, logger)
+    finally:
+        log_listener.stop()
+
+def cmd_bench(args):
+    import mqtt_bench
+    mqtt_bench.main(args.bench_args)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='IP address publisher, subscriber and dashboard over MQTT')
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    publish = commands.add_parser("publish", help="publish this host's IP addresses")
+    publish.add_argument('-c', '--config_file_path', default='mqtt_client_config.json', help='path to config file')
+    publish.add_argument('-d', '--daemon', action="store_true", help='stay connected and publish whenever the address changes')
+    publish.set_defaults(handler=cmd_publish)
+
+    subscribe = commands.add_parser("subscribe", help="subscribe and write the IP address page")
+    subscribe.add_argument('-c', '--config_file_path', default='mqtt_client_config.json', help='path to config file')
+    subscribe.set_defaults(handler=cmd_subscribe)
+
+    serve = commands.add_parser("serve", help="subscribe and serve the dashboard over HTTP")
+    serve.add_argument('-c', '--config_file_path', default='mqtt_client_config.json', help='path to config file')
+    serve.add_argument('--host', help='address to listen on (default http_host, or 0.0.0.0)')
+    serve.add_argument('--port', type=int, help='port to listen on (default http_port, or 8080)')
+    serve.set_defaults(handler=cmd_subscribe)
+
+    for command in (publish, subscribe, serve):
+        command.add_argument('--check', action="store_true", help='only validate the config file')
+
+    # every argument after "bench" is passed on to mqtt_bench
+    bench = commands.add_parser("bench", add_help=False,
+                                help="run the publisher/subscriber benchmark (see mqtt_bench.py -h)")
+    bench.set_defaults(handler=cmd_bench)
+
+    args, extra = parser.parse_known_args(argv)
+    if args.command == "bench":
+        args.bench_args = extra
+    elif extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    args.handler(args)
+
+if __name__ == '__main__':
+    main()
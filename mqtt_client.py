@@ -1,25 +1,161 @@
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition
+from collections import deque, OrderedDict
+from itertools import islice
+import asyncio
+import time
+import json
 
-import paho.mqtt.client as mqtt
-import ssl
+from mqtt_async_client import AsyncMqttClient, LoopThread
+from mqtt_logging import RateLimiter, queue_depth
+from mqtt_journal import MessageJournal
+from mqtt_metrics import MetricsRegistry
+from mqtt_router import TopicRouter
+from mqtt_codec import CODECS, PAYLOAD_BINARY, codec_for, codec_id, decode_payload
+
+class MqttRecord(object):
+    """
+    Compact record of a received message. Holds a memoryview of the payload
+    bytes rather than the paho MQTTMessage, and decodes the payload (as text
+    or JSON) at most once, on first use. seq is the MqttClient.msg_seq the
+    message arrived with. content_type is the MQTT v5 content type; payloads
+    of a binary codec (see mqtt_codec) decode to the same value as the JSON
+    form, and text() is then that value as JSON.
+    """
+    __slots__ = ("topic", "payload", "qos", "timestamp", "seq", "content_type", "_text", "_json")
+
+    def __init__(self, topic, payload, qos, timestamp, seq, content_type=None):
+        self.topic = topic
+        self.payload = memoryview(payload)
+        self.qos = qos
+        self.timestamp = timestamp
+        self.seq = seq
+        self.content_type = content_type
+        self._text = None
+        self._json = None
+
+    def is_binary(self):
+        codec = codec_for(self.content_type)
+        return codec != None and codec.payload_format == PAYLOAD_BINARY
+
+    def text(self):
+        if self._text == None:
+            if self.is_binary():
+                try:
+                    self._text, self._json = decode_payload(self.payload, self.content_type)
+                except ValueError:
+                    return f"<{len(self.payload)} bytes {self.content_type}>"
+            else:
+                self._text = str(self.payload, "UTF-8")
+        return self._text
+
+    def json(self):
+        # raises ValueError if the payload is not JSON (or does not decode)
+        if self._json == None:
+            if self.is_binary():
+                self._text, self._json = decode_payload(self.payload, self.content_type)
+            else:
+                self._json = json.loads(self.text())
+        return self._json
+
+    def __str__(self):
+        return f"{self.topic}: {self.text()}"
 
 class MqttClient(object):
     """
     MQTT client used to connect and subscribe to certain topics
     """
 
-    def __init__(self, config, logger):                
+    def __init__(self, config, logger, metrics=None):                
         self.logger = logger
         self.config = config
         self.mutex = Lock()
-        self.msg_lst = []
+        # signalled (with mutex held) whenever a message arrives
+        self.msg_cond = Condition(self.mutex)
         self.client = None
+
+        # fixed-capacity message store: appends are O(1) and the oldest
+        # messages fall off the front once the store is full. msg_store_size
+        # replaces msg_truncate_value, which is still read from older configs
+        store_size = config["msg_store_size"] if "msg_store_size" in config else config.get("msg_truncate_value", 20)
+        self.msg_store = deque(maxlen=store_size)
+        # total number of messages received, used as a cursor by consumers
+        self.msg_seq = 0
+        # latest value per topic, kept in order of last update so that
+        # get_changed_since() only walks the entries that actually changed
+        self.latest = OrderedDict()
         
         self.name = config["name"] if len(config["name"]) > 0 else "MqttClient"
 
+        # the connection is driven by an AsyncMqttClient on an event loop
+        # thread of our own, which hands its callbacks to this client and
+        # reconnects with backoff after a drop
+        self.aclient = AsyncMqttClient(config, logger, listener=self)
+        self.loop_thread = None
+        # TLS setup and connect latency of the last (re)connect
+        self.connect_timer = self.aclient.connect_timer
+
+        # connection counters, see get_connection_stats()
+        self.connected = False
+        self.stopping = False
+        self.disconnect_count = 0
+        self.disconnected_since = None
+        self.disconnected_total_s = 0.0
+        self.msgs_since_recovery = 0
+
+        # per-message log lines are rate limited (msg_log_rate lines/s, 0 for
+        # no limit) and on_message time is tracked, see get_callback_stats()
+        msg_log_rate = config["msg_log_rate"] if "msg_log_rate" in config else 10
+        self.msg_log_limiter = RateLimiter(msg_log_rate)
+        self.callback_time_max_s = 0.0
+
+        # metrics, shared with the caller's registry when one is passed in
+        self.metrics = metrics if metrics != None else MetricsRegistry()
+        self.msgs_received = self.metrics.counter("mqtt_messages_received_total",
+                                                  "Messages received, by subscribed topic filter", ["filter"])
+        self.bytes_received = self.metrics.counter("mqtt_received_bytes_total",
+                                                   "Payload bytes received, by subscribed topic filter", ["filter"])
+        self.callback_seconds = self.metrics.histogram("mqtt_on_message_seconds", "Time spent in on_message")
+        self.lock_wait_seconds = self.metrics.histogram("mqtt_store_lock_wait_seconds",
+                                                        "Time readers waited for the message store lock")
+        self.reconnects = self.metrics.counter("mqtt_reconnects_total", "Successful reconnects after a drop")
+        self.metrics.gauge("mqtt_store_messages", "Messages held in the store").set_function(lambda: len(self.msg_store))
+        self.metrics.gauge("mqtt_topics", "Topics in the latest-value index").set_function(lambda: len(self.latest))
+        self.metrics.gauge("mqtt_connected", "1 while connected to the broker").set_function(lambda: int(self.connected))
+        # the subscribed filters, to label metrics by the filter a topic matched
+        self.subscriptions = TopicRouter()
+        for topic_filter in config.get("topic_list", []):
+            self.subscriptions.add_route(topic_filter, queue_size=0)
+        # consumer routes, see add_route()
+        self.router = TopicRouter()
+
+        # optional on-disk journal; the newest message of every journaled
+        # topic is replayed into the store and per-topic index so a restart
+        # does not start empty
+        self.journal = None
+        if "journal_dir" in config and config["journal_dir"]:
+            self.journal = MessageJournal(config["journal_dir"], logger,
+                                          segment_size=config.get("journal_segment_size", 16 * 1024 * 1024),
+                                          max_segments=config.get("journal_max_segments", 8))
+            recovered = self.journal.recover()
+            for timestamp, topic, payload, flags in recovered:
+                self._add_record(self._journal_record(timestamp, topic, payload, flags))
+            self.msgs_since_recovery = 0
+            self.logger.info(f"Recovered the latest messages of {len(recovered)} topics from journal {config['journal_dir']}")
+
     # setting callbacks for different events to see if it works, print the message etc.
     def on_connect(self, client, userdata, flags, rc, properties=None):
         self.logger.info(f"[on_connect] CONNACK received with code {rc}")
+        self.connect_timer.connected(client)
+        if not rc.is_failure:
+            self.connected = True
+            if self.disconnected_since != None:
+                outage_s = time.monotonic() - self.disconnected_since
+                self.disconnected_total_s += outage_s
+                self.disconnected_since = None
+                self.msgs_since_recovery = 0
+                self.reconnects.inc()
+                self.logger.info(f"[on_connect] reconnected after {outage_s:.1f}s "
+                                 f"(disconnect #{self.disconnect_count})")
         if len(flags) > 0:
             self.logger.info(f"[on_connect] flags: {flags}")
         if properties != None:
@@ -31,6 +167,20 @@ class MqttClient(object):
             self.logger.info(f"[on_connect] subscribing to topic: {topic}")
             client.subscribe(topic, qos=1)
             
+    def on_disconnect(self, client, userdata, flags, rc, properties=None):
+        self.logger.info(f"[on_disconnect] reason_code: {rc}")
+        self.connected = False
+        if self.stopping:
+            return
+        if self.disconnected_since == None:
+            self.disconnect_count += 1
+            self.disconnected_since = time.monotonic()
+
+    def on_connect_fail(self, client, userdata):
+        # an outage was already counted by on_disconnect, and failing to make
+        # the first connection is not a disconnect
+        self.logger.info("[on_connect_fail] connection attempt failed")
+
     # print which topic was subscribed to
     def on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
         self.logger.info(f"[on_subscribe] Subscribed: {str(mid)}, QOS: {str(granted_qos)}")
@@ -47,42 +197,209 @@ class MqttClient(object):
             self.logger.info(f"[on_unsubscribe] reason_code: {reason_code}")
 
     def on_message(self, client, userdata, msg):
-        self.logger.info("[on_message] " + msg.topic + " " + str(msg.qos) + " " + str(msg.payload.decode('UTF-8')))
+        started = time.perf_counter()
+        content_type = getattr(msg.properties, "ContentType", None) if msg.properties != None else None
+        record = MqttRecord(msg.topic, msg.payload, msg.qos, time.time(), 0, content_type)
+        # the record is only decoded if the line is actually logged, and
+        # then the decoded text is reused by get_msgs()
+        allowed, suppressed = self.msg_log_limiter.allow()
+        if allowed:
+            if suppressed > 0:
+                self.logger.info("[on_message] (%d messages not logged)", suppressed)
+            self.logger.info("[on_message] (qos %d) %s", record.qos, record)
+        if self.journal != None:
+            # the journal's qos byte carries the codec id in its upper bits
+            self.journal.append(record.topic, record.payload, record.qos | codec_id(record.content_type) << 2,
+                                record.timestamp)
+        self._add_record(record)
+        self.router.dispatch(record)
+
+        topic_filter = self.match_filter(record.topic)
+        self.msgs_received.labels(topic_filter).inc()
+        self.bytes_received.labels(topic_filter).inc(len(record.payload))
+
+        elapsed_s = time.perf_counter() - started
+        self.callback_seconds.observe(elapsed_s)
+        if elapsed_s > self.callback_time_max_s:
+            self.callback_time_max_s = elapsed_s
+
+    def match_filter(self, topic):
+        # first subscribed filter (in topic_list order) matching 'topic'
+        routes = self.subscriptions.match(topic)
+        return routes[0].topic_filter if routes else ""
+
+    def add_route(self, topic_filter, handler=None, queue_size=1000):
+        """
+        Routes every received message whose topic matches 'topic_filter'
+        (with + and # wildcards) to 'handler' and/or a bounded queue of
+        'queue_size' records, in addition to the message store. Returns the
+        mqtt_router.Route; consumers take records with route.get() or
+        route.get_all(). The filter should be covered by topic_list.
+        """
+        return self.router.add_route(topic_filter, handler, queue_size)
+
+    def remove_route(self, route):
+        self.router.remove_route(route)
+
+    def _lock_store(self):
+        # acquire the store mutex for a reader, timing the wait
+        started = time.perf_counter()
+        self.mutex.acquire()
+        self.lock_wait_seconds.observe(time.perf_counter() - started)
+
+    def _add_record(self, record):
         with self.mutex:
-            self.msg_lst.append(msg)
+            self.msg_seq += 1
+            self.msgs_since_recovery += 1
+            record.seq = self.msg_seq
+            self.msg_store.append(record)
+            self.latest[record.topic] = record
+            self.latest.move_to_end(record.topic)
+            self.msg_cond.notify_all()
+
+    def forget(self, topic, seq=None):
+        """
+        Drops 'topic' from the latest-value index, unless it was updated
+        after cursor 'seq', so topics that went away do not hold memory.
+        Returns True if it was dropped.
+        """
+        with self.mutex:
+            record = self.latest.get(topic)
+            if record == None or (seq != None and record.seq > seq):
+                return False
+            del self.latest[topic]
+            return True
 
     def setup(self):
-        self.mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, 
-                                  client_id=self.config["client_id"], 
-                                  userdata=None, protocol=mqtt.MQTTv5)
-        self.mqttc.enable_logger(self.logger)
-
-        self.mqttc.on_connect     = self.on_connect
-        self.mqttc.on_subscribe   = self.on_subscribe
-        self.mqttc.on_unsubscribe = self.on_unsubscribe
-        self.mqttc.on_message     = self.on_message
-
-        # enable TLS for secure connection
-        self.mqttc.tls_set(tls_version=ssl.PROTOCOL_TLS)
-        # set username and password
-        self.mqttc.username_pw_set(self.config["client_username"], self.config["client_pw"])
+        # the paho client is the AsyncMqttClient's, with its callbacks
+        # forwarded to ours
+        self.loop_thread = LoopThread(f"mqtt-loop-{self.config['client_id']}")
+        self.aclient.setup(self.loop_thread.loop)
+        self.mqttc = self.aclient.mqttc
     
     def connect(self):
-        self.mqttc.connect(self.config["hivemq_url"], self.config["hivemq_port"], 
-                           clean_start=self.config["clean_start"])
+        # the connection (and every reconnect after a drop) is made on the
+        # event loop once start() is called, so a broker that is down at
+        # startup is retried rather than raising here
+        self.stopping = False
 
     def start(self):
-        self.mqttc.loop_start()
+        if self.journal != None:
+            self.journal.start()
+        self.aclient.run_threadsafe(self.aclient.connect(retry=True), wait=False)
                 
     def stop(self):
-        self.mqttc.loop_stop()
+        self.aclient.run_threadsafe(self.aclient.close())
+        self.loop_thread.stop()
+        if self.journal != None:
+            self.journal.stop()
+
+    def replay(self, start_time=None, end_time=None):
+        # journaled messages received between two epoch times, as MqttRecords
+        if self.journal == None:
+            return
+        for timestamp, topic, payload, flags in self.journal.replay(start_time, end_time):
+            yield self._journal_record(timestamp, topic, payload, flags)
+
+    def _journal_record(self, timestamp, topic, payload, flags):
+        codec = CODECS[flags >> 2] if flags >> 2 < len(CODECS) else None
+        content_type = codec.content_type if codec != None and flags >> 2 > 0 else None
+        return MqttRecord(topic, payload, flags & 3, timestamp, 0, content_type)
                 
     def disconnect(self):
-        self.mqttc.disconnect()
+        self.stopping = True
+        try:
+            self.aclient.run_threadsafe(self.aclient.disconnect(timeout=self.aclient.connect_timeout_s))
+        except asyncio.TimeoutError:
+            self.logger.warning("[disconnect] timed out")
+
+    def get_connection_stats(self):
+        disconnected_s = self.disconnected_total_s
+        if self.disconnected_since != None:
+            disconnected_s += time.monotonic() - self.disconnected_since
+        return {"connected": self.connected,
+                "disconnect_count": self.disconnect_count,
+                "disconnected_s": disconnected_s,
+                "reconnect_attempt": self.aclient.reconnect_attempt,
+                "msgs_since_recovery": self.msgs_since_recovery}
+
+    def get_callback_stats(self):
+        _, total_s, count = self.callback_seconds.get()
+        return {"on_message_count": count,
+                "on_message_avg_s": total_s / count if count > 0 else 0.0,
+                "on_message_max_s": self.callback_time_max_s,
+                "log_queue_depth": queue_depth(self.logger)}
                 
+    def decode_records(self, records):
+        """
+        Decodes the payloads of 'records' up front, as text and as JSON where
+        they parse, so later text()/json() calls are free. Returns records.
+        """
+        for record in records:
+            try:
+                record.json()
+            except ValueError:
+                pass
+        return records
+
+    def _snapshot(self, count):
+        # copy only the newest 'count' messages, walking back from the end
+        # (indexing into a deque is O(n)); called with mutex held
+        if count <= 0:
+            return []
+        return list(islice(reversed(self.msg_store), count))[::-1]
+
     def get_msgs(self, msg_truncate_value=None):
-        with self.mutex:
-            if msg_truncate_value != None:
-                self.msg_lst = self.msg_lst[-msg_truncate_value:]
-            msgs = [f"{msg.topic}: {str(msg.payload.decode('UTF-8'))}" for msg in self.msg_lst]
-        return msgs
+        self._lock_store()
+        try:
+            count = len(self.msg_store) if msg_truncate_value == None else msg_truncate_value
+            snapshot = self._snapshot(count)
+        finally:
+            self.mutex.release()
+        return [str(record) for record in snapshot]
+
+    def get_msgs_since(self, seq):
+        """
+        Returns (msgs, new_seq, missed) where msgs are the messages received
+        after cursor 'seq', new_seq is the cursor to pass on the next call and
+        missed is the number of messages that fell out of the store before
+        this consumer could read them.
+        """
+        self._lock_store()
+        try:
+            new_seq = self.msg_seq
+            pending = new_seq - seq
+            snapshot = self._snapshot(pending)
+        finally:
+            self.mutex.release()
+        missed = pending - len(snapshot)
+        msgs = [str(record) for record in snapshot]
+        return msgs, new_seq, missed
+
+    def get_changed_since(self, seq):
+        """
+        Returns (records, new_seq) where records is a list of MqttRecord for
+        every topic updated after cursor 'seq' (oldest first) and new_seq is
+        the cursor to pass on the next call. Pass 0 to get every topic.
+        """
+        records = []
+        self._lock_store()
+        try:
+            new_seq = self.msg_seq
+            for record in reversed(self.latest.values()):
+                if record.seq <= seq:
+                    break
+                records.append(record)
+        finally:
+            self.mutex.release()
+        records.reverse()
+        return records, new_seq
+
+    def wait_for_msgs(self, seq, timeout=None):
+        """
+        Blocks until a message newer than cursor 'seq' arrives or 'timeout'
+        seconds pass, and returns the current cursor.
+        """
+        with self.msg_cond:
+            self.msg_cond.wait_for(lambda: self.msg_seq > seq, timeout)
+            return self.msg_seq
@@ -2,20 +2,36 @@ import paho.mqtt.client as mqtt
 import ssl
 import time
 import signal
+import sys
+import logging
 from threading import Thread, Lock
 
+from mqtt_logging import start_queue_logging, RateLimiter
+
 mutex = Lock()
 doWork = True
 msg_lst = []
 
 log_file = "mqtt_client.log"
+logger = logging.getLogger("mqtt_client_web")
+log_listener = None
+# at most 10 per-message log lines a second
+msg_log_limiter = RateLimiter(10)
+
+def setupLogging():
+    # console and file handlers run on a QueueListener thread, so the paho
+    # network thread never waits on stdout or the log file
+    global log_listener
+    logFormatter = logging.Formatter("[%(asctime)s]: %(message)s", datefmt="%Y_%d_%m (%a) - %H:%M:%S")
+    consoleHandler = logging.StreamHandler(sys.stdout)
+    consoleHandler.setFormatter(logFormatter)
+    fileHandler = logging.FileHandler(log_file)
+    fileHandler.setFormatter(logFormatter)
+    logger.setLevel(logging.INFO)
+    log_listener = start_queue_logging(logger, [consoleHandler, fileHandler])
 
 def doLog(log_msg):
-    global log_file
-    msg = f"{time.strftime('[%Y_%d_%m (%a) - %H:%M:%S]', time.localtime())}: {log_msg}"
-    print (msg)
-    with open(log_file, "a") as file:
-        file.write(f"[{msg}\n")
+    logger.info(log_msg)
 
 # setting callbacks for different events to see if it works, print the message etc.
 def on_connect(client, userdata, flags, rc, properties=None):
@@ -47,13 +63,18 @@ def on_unsubscribe(client, userdata, mid, reason_code_list, properties=None):
         doLog(f"[on_unsubscribe] reason_code: {reason_code}")
 
 def on_message(client, userdata, msg):
-    doLog("[on_message] " + msg.topic + " " + str(msg.qos) + " " + str(msg.payload.decode('UTF-8')))
+    allowed, suppressed = msg_log_limiter.allow()
+    if allowed:
+        if suppressed > 0:
+            doLog(f"[on_message] ({suppressed} messages not logged)")
+        doLog("[on_message] " + msg.topic + " " + str(msg.qos) + " " + str(msg.payload.decode('UTF-8')))
     with mutex:
         msg_lst.append(msg)
 
 def main():
     global doWork, mutex
     signal.signal(signal.SIGINT, signal_handler)
+    setupLogging()
     
     # using MQTT version 5 here, for 3.1.1: MQTTv311, 3.1: MQTTv31
     # userdata is user defined data of any type, updated by user_data_set()
@@ -92,6 +113,7 @@ def main():
     doLog("Stopping client loop and disconnecting")
     client.loop_stop()
     client.disconnect()
+    log_listener.stop()
 
 def signal_handler(sig, frame):
     global doWork
@@ -0,0 +1,199 @@
+import json
+import socket
+import struct
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from ip_collector import primary_ipv4
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# MQTT v5 payload format indicator values
+PAYLOAD_BINARY = 0
+PAYLOAD_UTF8 = 1
+
+# struct layout, version 1: version, epoch ms, interface count, then per
+# interface its name length and name, IPv4 and IPv6 address counts, and the
+# packed addresses (4 and 16 bytes each)
+STRUCT_HDR = struct.Struct("<BQB")
+STRUCT_IFACE = struct.Struct("<BB")
+STRUCT_VERSION = 1
+
+def _host_message(timestamp_ms, interfaces, ip_address=None):
+    # the decoded form every codec returns, matching the JSON layout plus
+    # timestamp_ms; raises ValueError for a timestamp out of range
+    try:
+        timestamp = datetime.fromtimestamp(timestamp_ms / 1000).strftime(TIMESTAMP_FORMAT)
+    except (OverflowError, OSError, ValueError) as e:
+        raise ValueError(f"bad timestamp_ms {timestamp_ms}: {e}")
+    return {"timestamp": timestamp,
+            "timestamp_ms": timestamp_ms,
+            "ip_address": ip_address if ip_address != None else primary_ipv4(interfaces),
+            "interfaces": interfaces}
+
+def _check_host_message(data):
+    # raises ValueError unless 'data' has the layout the encoders produce
+    if not isinstance(data, dict):
+        raise ValueError(f"expected a map, not {type(data).__name__}")
+    timestamp_ms = data.get("timestamp_ms")
+    if not isinstance(timestamp_ms, (int, float)) or isinstance(timestamp_ms, bool):
+        raise ValueError(f"bad timestamp_ms: {timestamp_ms!r}")
+    if not isinstance(data.get("ip_address"), (str, type(None))):
+        raise ValueError(f"bad ip_address: {data.get('ip_address')!r}")
+    interfaces = data.get("interfaces")
+    if not isinstance(interfaces, dict):
+        raise ValueError(f"bad interfaces: {interfaces!r}")
+    for ifname, addresses in interfaces.items():
+        if not isinstance(ifname, str) or not isinstance(addresses, dict):
+            raise ValueError(f"bad interface {ifname!r}")
+        for family in ("ipv4", "ipv6"):
+            if not isinstance(addresses.get(family), list) or \
+                    not all(isinstance(address, str) for address in addresses[family]):
+                raise ValueError(f"bad {family} addresses for interface {ifname!r}")
+
+class JsonCodec(object):
+    """
+    The original payload: JSON with a formatted local time timestamp, plus
+    the epoch ms timestamp the binary codecs carry.
+    """
+    name = "json"
+    content_type = "application/json"
+    payload_format = PAYLOAD_UTF8
+
+    def encode(self, timestamp, interfaces):
+        # "timestamp" is the publisher's local time for people to read;
+        # timestamp_ms is what ages are computed from
+        return json.dumps({"timestamp": datetime.fromtimestamp(timestamp).strftime(TIMESTAMP_FORMAT),
+                           "timestamp_ms": int(timestamp * 1000),
+                           "ip_address": primary_ipv4(interfaces),
+                           "interfaces": interfaces}, separators=(",", ":")).encode("UTF-8")
+
+    def decode(self, payload):
+        return json.loads(str(payload, "UTF-8"))
+
+class MsgpackCodec(object):
+    """
+    MessagePack with an integer epoch ms timestamp. Needs the msgpack package.
+    """
+    name = "msgpack"
+    content_type = "application/msgpack"
+    payload_format = PAYLOAD_BINARY
+
+    def encode(self, timestamp, interfaces):
+        return msgpack.packb({"timestamp_ms": int(timestamp * 1000),
+                              "ip_address": primary_ipv4(interfaces),
+                              "interfaces": interfaces})
+
+    def decode(self, payload):
+        # raises ValueError for anything that is not an encoded host message
+        if msgpack == None:
+            raise ValueError("msgpack payload received but the msgpack package is not installed")
+        try:
+            data = msgpack.unpackb(payload)
+        except TypeError as e:
+            # eg. a map with an array as key
+            raise ValueError(f"bad msgpack payload: {e}")
+        _check_host_message(data)
+        return _host_message(data["timestamp_ms"], data["interfaces"], data.get("ip_address"))
+
+class StructCodec(object):
+    """
+    Fixed binary layout (see STRUCT_HDR) with epoch ms and packed addresses;
+    about a quarter the size of the JSON form.
+    """
+    name = "struct"
+    content_type = "application/vnd.ip-address.v1"
+    payload_format = PAYLOAD_BINARY
+
+    def encode(self, timestamp, interfaces):
+        parts = [STRUCT_HDR.pack(STRUCT_VERSION, int(timestamp * 1000), len(interfaces))]
+        for ifname in sorted(interfaces):
+            name = ifname.encode("UTF-8")
+            ipv4 = interfaces[ifname]["ipv4"]
+            ipv6 = interfaces[ifname]["ipv6"]
+            parts.append(bytes([len(name)]) + name + STRUCT_IFACE.pack(len(ipv4), len(ipv6)))
+            parts.extend(socket.inet_pton(socket.AF_INET, address) for address in ipv4)
+            parts.extend(socket.inet_pton(socket.AF_INET6, address) for address in ipv6)
+        return b"".join(parts)
+
+    def decode(self, payload):
+        # raises ValueError for a truncated payload or an unknown version
+        payload = bytes(payload)
+        try:
+            version, timestamp_ms, count = STRUCT_HDR.unpack_from(payload, 0)
+            if version != STRUCT_VERSION:
+                raise ValueError(f"unknown struct payload version {version}")
+            offset = STRUCT_HDR.size
+            interfaces = {}
+            for _ in range(count):
+                name_len = payload[offset]
+                ifname = payload[offset + 1:offset + 1 + name_len].decode("UTF-8")
+                offset += 1 + name_len
+                ipv4_count, ipv6_count = STRUCT_IFACE.unpack_from(payload, offset)
+                offset += STRUCT_IFACE.size
+                ipv4 = []
+                for _ in range(ipv4_count):
+                    ipv4.append(socket.inet_ntop(socket.AF_INET, payload[offset:offset + 4]))
+                    offset += 4
+                ipv6 = []
+                for _ in range(ipv6_count):
+                    ipv6.append(socket.inet_ntop(socket.AF_INET6, payload[offset:offset + 16]))
+                    offset += 16
+                interfaces[ifname] = {"ipv4": ipv4, "ipv6": ipv6}
+        except (struct.error, IndexError, OSError) as e:
+            raise ValueError(f"bad struct payload: {e}")
+        return _host_message(timestamp_ms, interfaces)
+
+# the position in CODECS is the codec id stored in the journal
+CODECS = [JsonCodec(), MsgpackCodec(), StructCodec()]
+CODECS_BY_NAME = {codec.name: codec for codec in CODECS}
+CODECS_BY_CONTENT_TYPE = {codec.content_type: codec for codec in CODECS}
+
+def get_codec(name):
+    """
+    Returns the codec called 'name' ("json", "msgpack" or "struct"), raising
+    ValueError for an unknown name or when msgpack is not installed.
+    """
+    if name not in CODECS_BY_NAME:
+        raise ValueError(f"unknown payload codec: {name}")
+    if name == "msgpack" and msgpack == None:
+        raise ValueError("payload codec msgpack needs the msgpack package (pip install msgpack)")
+    return CODECS_BY_NAME[name]
+
+def codec_for(content_type):
+    # codec announced by an MQTT v5 content type, or None (plain text/JSON)
+    return CODECS_BY_CONTENT_TYPE.get(content_type)
+
+def decode_payload(payload, content_type):
+    """
+    Returns (text, value) for a received payload: for a binary codec the
+    decoded value and its JSON text, otherwise the UTF-8 text and its JSON
+    value. Raises ValueError if the payload does not decode.
+    """
+    codec = CODECS_BY_CONTENT_TYPE.get(content_type)
+    if codec != None and codec.payload_format == PAYLOAD_BINARY:
+        value = codec.decode(payload)
+        return json.dumps(value, separators=(",", ":")), value
+    text = str(payload, "UTF-8")
+    return text, json.loads(text)
+
+def codec_id(content_type):
+    codec = CODECS_BY_CONTENT_TYPE.get(content_type)
+    return CODECS.index(codec) if codec != None else 0
+
+def publish_properties(codec):
+    """
+    MQTT v5 PUBLISH properties announcing 'codec' through the content type
+    and payload format indicator.
+    """
+    # imported here so encoding and decoding do not pull in paho
+    from paho.mqtt.properties import Properties
+    from paho.mqtt.packettypes import PacketTypes
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.ContentType = codec.content_type
+    properties.PayloadFormatIndicator = codec.payload_format
+    return properties
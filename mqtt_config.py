@@ -0,0 +1,200 @@
+import sys
+import json
+import logging
+
+from mqtt_logging import start_queue_logging
+
+NUMBER = (int, float)
+
+class ConfigError(ValueError):
+    """
+    Raised by load_config() with every problem found in a config file.
+    """
+
+class Field(object):
+    """
+    Expected type(s) of one config key. Optional keys may also be null.
+    'above' is an exclusive minimum, for values that must be positive.
+    """
+    __slots__ = ("types", "required", "choices", "minimum", "maximum", "above")
+
+    def __init__(self, types, required=False, choices=None, minimum=None, maximum=None, above=None):
+        self.types = types if isinstance(types, tuple) else (types,)
+        self.required = required
+        self.choices = choices
+        self.minimum = minimum
+        self.maximum = maximum
+        self.above = above
+
+COMMON_SCHEMA = {
+    "name":                 Field(str),
+    "log_file_path":        Field(str),
+    "log_file_name":        Field(str),     # older name of log_file_path
+    "client_id":            Field(str, required=True),
+    "client_username":      Field(str, required=True),
+    "client_pw":            Field(str, required=True),
+    "hivemq_url":           Field(str, required=True),
+    "hivemq_port":          Field(int, required=True, minimum=1, maximum=65535),
+    "use_tls":              Field(bool),
+    "tls_ca_file":          Field(str),
+    "connect_timeout_s":    Field(NUMBER, above=0),
+    "topic_list":           Field(list, required=True),
+    "metrics_port":         Field(int, minimum=0, maximum=65535),
+}
+
+CLIENT_SCHEMA = dict(COMMON_SCHEMA, **{
+    "clean_start":          Field(bool, required=True),
+    "subscribe_qos":        Field(int, required=True, choices=(0, 1, 2)),
+    "reconnect_min_delay_s": Field(NUMBER, above=0),
+    "reconnect_max_delay_s": Field(NUMBER, above=0),
+    "msg_log_rate":         Field(NUMBER, minimum=0),
+    "render_debounce_s":    Field(NUMBER, minimum=0),
+    "html_file_name":       Field(str),
+    "write_html_file":      Field(bool),
+    "http_host":            Field(str),
+    "http_port":            Field(int, minimum=0, maximum=65535),
+    "msg_truncate_value":   Field(int, minimum=1),  # older name of msg_store_size
+    "msg_store_size":       Field(int, minimum=1),
+    "journal_dir":          Field(str),
+    "journal_segment_size": Field(int, minimum=4096),
+    "journal_max_segments": Field(int, minimum=1),
+    "host_ttl_s":           Field(NUMBER, minimum=0),
+    "host_stale_after_s":   Field(NUMBER, minimum=0),
+    "max_hosts":            Field(int, minimum=1),
+    "html_page_size":       Field(int, minimum=1),
+    "stale_check_s":        Field(NUMBER, minimum=0),
+    "brokers":              Field(list),
+    "connections":          Field(int, minimum=1),
+    "share_group":          Field(str),
+})
+
+PUBLISHER_SCHEMA = dict(COMMON_SCHEMA, **{
+    "publish_qos":          Field(int, required=True, choices=(0, 1, 2)),
+    "ifname":               Field((str, list), required=True),
+    "max_inflight":         Field(int, minimum=1),
+    "publish_timeout_s":    Field(NUMBER, minimum=0),
+    "retain":               Field(bool),
+    "daemon":               Field(bool),
+    "poll_interval_s":      Field(NUMBER, minimum=0),
+    "heartbeat_s":          Field(NUMBER, minimum=0),
+    "payload_codec":        Field(str, choices=("json", "msgpack", "struct")),
+    "outbox_path":          Field(str),
+    "outbox_batch_size":    Field(int, minimum=1),
+    "outbox_retry_s":       Field(NUMBER, above=0),
+})
+
+SCHEMAS = {"client": CLIENT_SCHEMA, "publisher": PUBLISHER_SCHEMA}
+
+# (smaller key, larger key) pairs checked once both values passed their own checks
+ORDERED_KEYS = [("reconnect_min_delay_s", "reconnect_max_delay_s")]
+
+def _compile_field(key, field):
+    # returns a function of the value giving an error message or None
+    def check(value):
+        if value == None:
+            return f"'{key}' must not be null" if field.required else None
+        # bool is an int subclass, but true is not a port number
+        if not isinstance(value, field.types) or (isinstance(value, bool) and bool not in field.types):
+            names = " or ".join(t.__name__ for t in field.types)
+            return f"'{key}' must be {names}, not {type(value).__name__}"
+        if field.choices != None and value not in field.choices:
+            return f"'{key}' must be one of {', '.join(map(str, field.choices))}, not {value}"
+        if field.minimum != None and value < field.minimum:
+            return f"'{key}' must be at least {field.minimum}, not {value}"
+        if field.above != None and value <= field.above:
+            return f"'{key}' must be greater than {field.above}, not {value}"
+        if field.maximum != None and value > field.maximum:
+            return f"'{key}' must be at most {field.maximum}, not {value}"
+        return None
+    return check
+
+_compiled = {}
+
+def compile_schema(schema_name):
+    """
+    Returns the schema as (required keys, {key: check function}), built on
+    first use and then reused.
+    """
+    if schema_name not in _compiled:
+        schema = SCHEMAS[schema_name]
+        required = tuple(key for key, field in schema.items() if field.required)
+        checks = {key: _compile_field(key, field) for key, field in schema.items()}
+        _compiled[schema_name] = (required, checks)
+    return _compiled[schema_name]
+
+def validate_config(config, schema_name):
+    """
+    Returns (errors, unknown keys) for a config dict checked against the
+    "client" or "publisher" schema.
+    """
+    required, checks = compile_schema(schema_name)
+    if not isinstance(config, dict):
+        return ["the config must be a JSON object"], []
+    errors = [f"'{key}' is missing" for key in required if key not in config]
+    unknown = []
+    invalid = set()
+    for key, value in config.items():
+        check = checks.get(key)
+        if check == None:
+            unknown.append(key)
+            continue
+        error = check(value)
+        if error != None:
+            errors.append(error)
+            invalid.add(key)
+    for low, high in ORDERED_KEYS:
+        if low not in checks or low in invalid or high in invalid:
+            continue
+        if config.get(low) != None and config.get(high) != None and config[low] > config[high]:
+            errors.append(f"'{low}' ({config[low]}) must not be greater than '{high}' ({config[high]})")
+    return errors, unknown
+
+def load_config(path, schema_name, logger=None):
+    """
+    Reads and validates a JSON config file, raising ConfigError listing
+    every problem. Unknown keys (often typos) are logged as warnings.
+    """
+    try:
+        with open(path) as config_file:
+            config = json.load(config_file)
+    except FileNotFoundError:
+        raise ConfigError(f"Config file not found: {path}")
+    except ValueError as e:
+        raise ConfigError(f"Error parsing config file {path}: {e}")
+
+    errors, unknown = validate_config(config, schema_name)
+    if errors:
+        raise ConfigError(f"Config file {path} is not valid: " + "; ".join(errors))
+    if logger != None and unknown:
+        logger.warning(f"Config file {path} has unknown keys: {', '.join(unknown)}")
+    return config
+
+def get_log_file_path(config, default):
+    # log_file_path, or the older log_file_name, or 'default'
+    for key in ("log_file_path", "log_file_name"):
+        if key in config and config[key]:
+            return config[key]
+    return default
+
+LOG_FORMAT = "%(asctime)s [%(name)s] (%(levelname)s): %(message)s"
+
+def create_logger(name):
+    """
+    Returns (logger, console handler) for a command line tool, logging to
+    stdout until start_logging() adds the log file.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(console_handler)
+    return logger, console_handler
+
+def start_logging(logger, console_handler, config, default_log_file):
+    """
+    Adds the config's log file and moves both handlers onto a queue
+    listener thread (see mqtt_logging). Returns the listener.
+    """
+    file_handler = logging.FileHandler(get_log_file_path(config, default_log_file))
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    return start_queue_logging(logger, [console_handler, file_handler])
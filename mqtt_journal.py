@@ -0,0 +1,199 @@
+import os
+import mmap
+import struct
+from threading import Thread, Lock, Condition
+
+# record layout: total length (including this header), receive time (epoch
+# seconds), qos, topic length, then the topic and payload bytes
+RECORD_HDR = struct.Struct("<IdBH")
+SEGMENT_PREFIX = "journal-"
+SEGMENT_SUFFIX = ".seg"
+
+def _read_records(data):
+    # yields (timestamp, topic, payload, qos) from a segment's bytes and
+    # stops at a truncated record (eg. the tail of a crashed write)
+    offset = 0
+    end = len(data)
+    while offset + RECORD_HDR.size <= end:
+        length, timestamp, qos, topic_len = RECORD_HDR.unpack_from(data, offset)
+        if length < RECORD_HDR.size + topic_len or offset + length > end:
+            break
+        topic_start = offset + RECORD_HDR.size
+        payload_start = topic_start + topic_len
+        yield (timestamp, bytes(data[topic_start:payload_start]).decode("UTF-8"),
+               bytes(data[payload_start:offset + length]), qos)
+        offset += length
+
+def _valid_length(data):
+    # length of the whole records at the start of 'data'; anything after
+    # that is a torn tail
+    offset = 0
+    end = len(data)
+    while offset + RECORD_HDR.size <= end:
+        length, _, _, topic_len = RECORD_HDR.unpack_from(data, offset)
+        if length < RECORD_HDR.size + topic_len or offset + length > end:
+            break
+        offset += length
+    return offset
+
+class MessageJournal(object):
+    """
+    Append-only on-disk journal of received messages. Records are
+    length-prefixed binary, written in batches by a background thread into
+    numbered segment files that rotate at 'segment_size' bytes; only the
+    newest 'max_segments' are kept. A restart carries on in the newest
+    segment, after cutting off any torn record a crash left at its end.
+    """
+
+    def __init__(self, journal_dir, logger, segment_size=16 * 1024 * 1024, max_segments=8,
+                 flush_interval_s=0.5):
+        self.journal_dir = journal_dir
+        self.logger = logger
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.flush_interval_s = flush_interval_s
+
+        self.pending = []
+        self.pending_cond = Condition(Lock())
+        self.stopping = False
+        self.thread = None
+        self.file = None
+        self.segment_no = 0
+
+        os.makedirs(journal_dir, exist_ok=True)
+
+    def segments(self):
+        # segment paths, oldest first
+        names = [name for name in os.listdir(self.journal_dir)
+                 if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)]
+        return [os.path.join(self.journal_dir, name) for name in sorted(names)]
+
+    def start(self):
+        segments = self.segments()
+        if segments:
+            last = os.path.basename(segments[-1])
+            self.segment_no = int(last[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            self._truncate_torn_tail(segments[-1])
+            self.file = open(segments[-1], "ab")
+        else:
+            self._rotate()
+        self.thread = Thread(target=self._writer, name="MessageJournal", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.pending_cond:
+            self.stopping = True
+            self.pending_cond.notify()
+        if self.thread != None:
+            self.thread.join()
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+    def append(self, topic, payload, qos, timestamp):
+        # called from the network thread; only queues the encoded record
+        topic_bytes = topic.encode("UTF-8")
+        header = RECORD_HDR.pack(RECORD_HDR.size + len(topic_bytes) + len(payload), timestamp, qos, len(topic_bytes))
+        with self.pending_cond:
+            self.pending.append(header + topic_bytes + payload)
+
+    def _writer(self):
+        while True:
+            with self.pending_cond:
+                if not self.stopping:
+                    self.pending_cond.wait(self.flush_interval_s)
+                batch, self.pending = self.pending, []
+                stopping = self.stopping
+            if batch:
+                try:
+                    self._write(b"".join(batch))
+                except OSError as err:
+                    self.logger.error(f"[journal] write failed, {len(batch)} records lost: {err}")
+            if stopping:
+                break
+
+    def _write(self, data):
+        if self.file.tell() > 0 and self.file.tell() + len(data) > self.segment_size:
+            self._rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def _rotate(self):
+        if self.file != None:
+            self.file.close()
+        self.segment_no += 1
+        path = os.path.join(self.journal_dir, f"{SEGMENT_PREFIX}{self.segment_no:08d}{SEGMENT_SUFFIX}")
+        self.file = open(path, "ab")
+        for old in self.segments()[:-self.max_segments]:
+            os.remove(old)
+
+    def _truncate_torn_tail(self, path):
+        # new records must not be appended after a partial one
+        with open(path, "r+b") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                valid = _valid_length(data)
+            if valid < size:
+                self.logger.warning(f"[journal] dropping {size - valid} bytes of a torn record at the end of {path}")
+                file.truncate(valid)
+
+    def _segment_records(self, path):
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return list(_read_records(data))
+
+    def _first_timestamp(self, path):
+        with open(path, "rb") as file:
+            header = file.read(RECORD_HDR.size)
+        if len(header) < RECORD_HDR.size:
+            return None
+        return RECORD_HDR.unpack(header)[1]
+
+    def recover(self):
+        """
+        Returns the newest record of every journaled topic, oldest first;
+        used to rebuild in-memory state on startup. Walks the segments from
+        newest to oldest, so a topic last heard of several segments back is
+        still recovered.
+        """
+        seen = set()
+        latest = []     # newest first
+        for path in reversed(self.segments()):
+            try:
+                records = self._segment_records(path)
+            except FileNotFoundError:
+                continue
+            for record in reversed(records):
+                if record[1] not in seen:
+                    seen.add(record[1])
+                    latest.append(record)
+        latest.reverse()
+        return latest
+
+    def replay(self, start_time=None, end_time=None):
+        """
+        Yields (timestamp, topic, payload, qos) for every journaled record
+        received between 'start_time' and 'end_time' (epoch seconds, either
+        may be None), oldest first. Segments that end before 'start_time'
+        are skipped without being read.
+        """
+        segments = self.segments()
+        for index, path in enumerate(segments):
+            if start_time != None and index + 1 < len(segments):
+                next_first = self._first_timestamp(segments[index + 1])
+                if next_first != None and next_first < start_time:
+                    continue
+            try:
+                records = self._segment_records(path)
+            except FileNotFoundError:
+                continue    # rotated away while we were reading
+            for record in records:
+                if start_time != None and record[0] < start_time:
+                    continue
+                if end_time != None and record[0] > end_time:
+                    return
+                yield record
@@ -0,0 +1,58 @@
+import logging
+import logging.handlers
+import queue
+import time
+from threading import Lock
+
+def start_queue_logging(logger, handlers):
+    """
+    Moves 'handlers' (console, file, ...) off the calling threads: 'logger'
+    gets a single QueueHandler, and a QueueListener thread feeds the records
+    to the real handlers. This keeps disk and stdout stalls out of paho's
+    network thread. Returns the listener; call stop() on it at exit to
+    flush the queue.
+    """
+    log_queue = queue.Queue(-1)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def queue_depth(logger):
+    # number of records waiting for the listener, 0 if not queue logging
+    for handler in logger.handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            return handler.queue.qsize()
+    return 0
+
+class RateLimiter(object):
+    """
+    Token bucket for per-message log lines: allow() is True for at most
+    'rate' calls per second (with bursts up to 'burst'), and counts the calls
+    it turned down so the next logged line can report them.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst != None else max(1, rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.mutex = Lock()
+
+    def allow(self):
+        # returns (allowed, suppressed since the last allowed call)
+        if self.rate <= 0:
+            return True, 0
+        with self.mutex:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False, 0
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return True, suppressed
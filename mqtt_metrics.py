@@ -0,0 +1,247 @@
+import bisect
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock, get_ident
+
+# default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra != None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+class _Cells(object):
+    """
+    Per-thread accumulators: each thread only ever writes its own cell, so
+    updates take no lock, and readers sum the cells. Cells are lists of
+    'width' numbers.
+    """
+    __slots__ = ("cells", "width")
+
+    def __init__(self, width):
+        self.cells = {}
+        self.width = width
+
+    def cell(self):
+        cell = self.cells.get(get_ident())
+        if cell == None:
+            cell = self.cells.setdefault(get_ident(), [0] * self.width)
+        return cell
+
+    def total(self):
+        totals = [0] * self.width
+        for cell in list(self.cells.values()):
+            for index, value in enumerate(cell):
+                totals[index] += value
+        return totals
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.children_lock = Lock()
+
+    def labels(self, *labelvalues):
+        child = self.children.get(labelvalues)
+        if child == None:
+            with self.children_lock:
+                child = self.children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, child in list(self.children.items()):
+            lines.extend(self._render_child(labelvalues, child))
+        return lines
+
+class _CounterChild(object):
+    __slots__ = ("values",)
+
+    def __init__(self):
+        self.values = _Cells(1)
+
+    def inc(self, amount=1):
+        self.values.cell()[0] += amount
+
+    def get(self):
+        return self.values.total()[0]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def get(self):
+        return self.labels().get()
+
+    def _render_child(self, labelvalues, child):
+        return [f"{self.name}{_format_labels(self.labelnames, labelvalues)} {child.get()}"]
+
+class _GaugeChild(object):
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        # the gauge reads function() at collection time, eg. a queue length
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function != None else self.value
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def get(self):
+        return self.labels().get()
+
+    def _render_child(self, labelvalues, child):
+        return [f"{self.name}{_format_labels(self.labelnames, labelvalues)} {child.get()}"]
+
+class _HistogramChild(object):
+    __slots__ = ("buckets", "values")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one count per bucket, then +Inf, sum and count
+        self.values = _Cells(len(buckets) + 3)
+
+    def observe(self, value):
+        cell = self.values.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def get(self):
+        # returns (cumulative bucket counts including +Inf, sum, count)
+        totals = self.values.total()
+        cumulative = []
+        running = 0
+        for count in totals[:-2]:
+            running += count
+            cumulative.append(running)
+        return cumulative, totals[-2], totals[-1]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def get(self):
+        return self.labels().get()
+
+    def _render_child(self, labelvalues, child):
+        cumulative, total, count = child.get()
+        lines = []
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), cumulative):
+            labels = _format_labels(self.labelnames, labelvalues, ("le", bound))
+            lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class MetricsRegistry(object):
+    """
+    Set of metrics for one process (or one client instance). Metrics are
+    created through counter()/gauge()/histogram(), which return the existing
+    metric when the name is already registered. render() produces the
+    Prometheus text exposition format; collect() yields (name, kind,
+    description, lines) for other exporters.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def _get_or_create(self, cls, name, description, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric == None:
+                metric = self.metrics[name] = cls(name, description, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self._get_or_create(Counter, name, description, labelnames)
+
+    def gauge(self, name, description, labelnames=()):
+        return self._get_or_create(Gauge, name, description, labelnames)
+
+    def histogram(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, description, labelnames, buckets=buckets)
+
+    def collect(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            yield metric.name, metric.kind, metric.description, metric.render()
+
+    def render(self):
+        lines = []
+        for _, _, _, metric_lines in self.collect():
+            lines.extend(metric_lines)
+        return "\n".join(lines) + "\n"
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve_metrics(registry, host, port):
+    """
+    Serves 'registry' on http://host:port/metrics from a background thread,
+    for processes without a DashboardServer. Returns the server; call
+    shutdown() on it to stop.
+    """
+    httpd = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    httpd.daemon_threads = True
+    httpd.registry = registry
+    Thread(target=httpd.serve_forever, name="MetricsServer", daemon=True).start()
+    return httpd
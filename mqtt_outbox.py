@@ -0,0 +1,68 @@
+import os
+import time
+import sqlite3
+from threading import Lock
+
+class Outbox(object):
+    """
+    Durable store-and-forward queue of outgoing messages in an SQLite
+    database (WAL mode, so a write is one append to the log). Messages are
+    keyed by topic: putting a message replaces any that is still waiting for
+    the same topic, so after an outage only the newest one per topic is
+    sent. Each message carries a sequence number so that a delivery can only
+    remove the exact version that was sent.
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                               topic TEXT PRIMARY KEY,
+                               seq INTEGER NOT NULL,
+                               payload BLOB NOT NULL,
+                               retain INTEGER NOT NULL,
+                               content_type TEXT,
+                               payload_format INTEGER,
+                               created REAL NOT NULL)""")
+        row = self.db.execute("SELECT MAX(seq) FROM outbox").fetchone()
+        self.seq = row[0] if row[0] != None else 0
+
+    def put(self, topic, payload, retain=False, content_type=None, payload_format=None):
+        if isinstance(payload, str):
+            payload = payload.encode("UTF-8")
+        with self.lock:
+            self.seq += 1
+            self.db.execute("INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (topic, self.seq, bytes(payload), int(retain), content_type, payload_format,
+                             time.time()))
+            return self.seq
+
+    def pending(self, limit=100):
+        """
+        Returns up to 'limit' waiting messages, oldest first, as tuples of
+        (topic, seq, payload, retain, content_type, payload_format, created).
+        """
+        with self.lock:
+            return self.db.execute("SELECT topic, seq, payload, retain, content_type, payload_format, created "
+                                   "FROM outbox ORDER BY seq LIMIT ?", (limit,)).fetchall()
+
+    def remove(self, delivered):
+        # drops the (topic, seq) pairs that were delivered, unless a newer
+        # message for the topic was put in the meantime
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("DELETE FROM outbox WHERE topic = ? AND seq = ?", delivered)
+            self.db.execute("COMMIT")
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
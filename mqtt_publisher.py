@@ -1,31 +1,98 @@
+from threading import Thread, Lock, Condition
+import asyncio
+import time
+import itertools
+
 import paho.mqtt.client as mqtt
-import ssl
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+from mqtt_async_client import AsyncMqttClient, LoopThread
+from mqtt_metrics import MetricsRegistry
+from mqtt_outbox import Outbox
 
 class MqttPublisher(object):
     """
     MQTT publisher used to connect and publish to certain topics
     """
 
-    def __init__(self, config, logger):                
+    def __init__(self, config, logger, metrics=None):                
         self.logger = logger
         self.config = config
         self.client = None
         
         self.name = config["name"] if len(config["name"]) > 0 else "MqttPublisher"
 
+        # the connection is driven by an AsyncMqttClient on an event loop
+        # thread of our own, which hands its callbacks to this publisher
+        # and reconnects with backoff after a drop
+        self.aclient = AsyncMqttClient(config, logger, listener=self)
+        self.loop_thread = None
+        # TLS setup and connect latency of the last (re)connect
+        self.connect_timer = self.aclient.connect_timer
+
+        # acknowledgement tracking for publish_many(); on_publish records the
+        # ack time per mid, publish_many() matches them to what it sent
+        self.ack_cond = Condition(Lock())
+        self.acked = {}
+        self.tracking_acks = False
+        self.inflight_count = 0
+
+        # metrics, shared with the caller's registry when one is passed in
+        self.metrics = metrics if metrics != None else MetricsRegistry()
+        self.msgs_published = self.metrics.counter("mqtt_messages_published_total",
+                                                   "Messages published, by topic", ["topic"])
+        self.bytes_published = self.metrics.counter("mqtt_published_bytes_total",
+                                                    "Payload bytes published, by topic", ["topic"])
+        self.publish_failures = self.metrics.counter("mqtt_publish_failures_total",
+                                                     "Publishes that failed or were not acknowledged")
+        self.ack_seconds = self.metrics.histogram("mqtt_publish_ack_seconds",
+                                                  "Time from publish to PUBACK/PUBCOMP in publish_many")
+        self.metrics.gauge("mqtt_inflight_messages",
+                           "QoS 1/2 messages awaiting acknowledgement").set_function(lambda: self.inflight_count)
+
+        # optional durable outbox (outbox_path): publish() writes to it and a
+        # drainer thread sends it in batches whenever connected
+        self.outbox = None
+        self.connected = False
+        self.stopping = False
+        self.drain_cond = Condition(Lock())
+        self.drain_wanted = True
+        self.drain_thread = None
+        self.drain_batch_size = config["outbox_batch_size"] if "outbox_batch_size" in config else 100
+        self.drain_retry_s = config["outbox_retry_s"] if "outbox_retry_s" in config else 5
+        if "outbox_path" in config and config["outbox_path"]:
+            self.outbox = Outbox(config["outbox_path"])
+            self.metrics.gauge("mqtt_outbox_messages",
+                               "Messages waiting in the outbox").set_function(lambda: len(self.outbox))
+
     # setting callbacks for different events to see if it works, print the message etc.
     def on_connect(self, client, userdata, flags, rc, properties=None):
         self.logger.info(f"[on_connect] CONNACK received with code {rc}")
+        self.connect_timer.connected(client)
+        if not rc.is_failure:
+            with self.drain_cond:
+                self.connected = True
+                self.drain_wanted = True
+                self.drain_cond.notify_all()
         if len(flags) > 0:
             self.logger.info(f"[on_connect] flags: {flags}")
         if properties != None:
             self.logger.info(f"[on_connect] props: {properties}")
                     
+    def on_disconnect(self, client, userdata, flags, rc, properties=None):
+        self.logger.info(f"[on_disconnect] reason_code: {rc}")
+        self.connected = False
+
     def on_publish(self, client, userdata, mid, reason_code, properties=None):
         self.logger.info(f"[on_publish] Mid: {str(mid)}")
         if properties != None:
             self.logger.info(f"[on_publish] props: {properties}")
         self.logger.info(f"[on_publish] reason_code: {reason_code}")
+        with self.ack_cond:
+            if self.tracking_acks:
+                self.acked[mid] = (time.monotonic(), reason_code)
+                self.ack_cond.notify_all()
 
     def on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
         self.logger.info(f"[on_subscribe] Subscribed: {str(mid)}, QOS: {str(granted_qos)}")
@@ -45,34 +112,222 @@ class MqttPublisher(object):
         self.logger.info("[on_message] " + msg.topic + " " + str(msg.qos) + " " + str(msg.payload.decode('UTF-8')))
 
     def setup(self):
-        self.mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, 
-                                  client_id=self.config["client_id"], 
-                                  userdata=None, protocol=mqtt.MQTTv5)
-        self.mqttc.enable_logger(self.logger)
-
-        self.mqttc.on_connect     = self.on_connect
-        self.mqttc.on_publish     = self.on_publish
-        self.mqttc.on_subscribe   = self.on_subscribe
-        self.mqttc.on_unsubscribe = self.on_unsubscribe
-        self.mqttc.on_message     = self.on_message
-
-        # enable TLS for secure connection
-        self.mqttc.tls_set(tls_version=ssl.PROTOCOL_TLS)
-        # set username and password
-        self.mqttc.username_pw_set(self.config["client_username"], self.config["client_pw"])
+        # the paho client is the AsyncMqttClient's, with its callbacks
+        # forwarded to ours
+        self.loop_thread = LoopThread(f"mqtt-loop-{self.config['client_id']}")
+        self.aclient.setup(self.loop_thread.loop)
+        self.mqttc = self.aclient.mqttc
     
-    def connect(self):
-        self.mqttc.connect(self.config["hivemq_url"], self.config["hivemq_port"])
+    def connect(self, retry=False):
+        # with 'retry' (eg. a daemon) or an outbox an unreachable broker is
+        # not an error: the event loop keeps retrying in the background,
+        # and the drainer sends the outbox once connected. Otherwise this
+        # waits for the CONNACK and raises if the broker can't be reached.
+        self.stopping = False
+        if self.outbox != None or retry:
+            self.aclient.run_threadsafe(self.aclient.connect(retry=True), wait=False)
+        else:
+            self.aclient.run_threadsafe(self.aclient.connect(timeout=self.aclient.connect_timeout_s))
 
     def start(self):
-        self.mqttc.loop_start()
+        if self.outbox != None:
+            self.drain_thread = Thread(target=self._drain, name="OutboxDrainer", daemon=True)
+            self.drain_thread.start()
                 
     def stop(self):
-        self.mqttc.loop_stop()
+        with self.drain_cond:
+            self.stopping = True
+            self.drain_cond.notify_all()
+        if self.drain_thread != None:
+            self.drain_thread.join()
+            self.drain_thread = None
+        self.aclient.run_threadsafe(self.aclient.close())
+        self.loop_thread.stop()
+        if self.outbox != None:
+            self.outbox.close()
         
-    def publish(self, topic, message):
+    def publish(self, topic, message, retain=False, properties=None):
+        """
+        Publishes one message and returns paho's MQTTMessageInfo. With an
+        outbox the message is written to it instead, to be sent by the
+        drainer, and None is returned; see flush().
+        """
+        if self.outbox != None:
+            self.enqueue(topic, message, retain, properties)
+            return None
+        qos = self.config["publish_qos"]
+        self.msgs_published.labels(topic).inc()
+        self.bytes_published.labels(topic).inc(len(message))
+        return self.mqttc.publish(topic, message, qos=qos, retain=retain, properties=properties)
+
+    def publish_many(self, messages, max_inflight=None, timeout=None, retain=False, properties=None):
+        """
+        Publishes an iterable of (topic, payload) pairs, keeping at most
+        'max_inflight' QoS 1/2 messages unacknowledged at a time, and waits up
+        to 'timeout' seconds for each acknowledgement. Requires the network
+        loop to be running (start()). 'properties' (MQTT v5, eg. from
+        mqtt_codec.publish_properties()) are sent with every message.
+
+        Returns (results, stats): results has one dict per message with
+        topic, mid, rc, acked, queued and latency_s (messages left unsent
+        after an ack timeout have mid and rc None; queued is True for a QoS
+        1/2 message published while disconnected, which paho keeps and sends
+        after reconnecting); stats has count, acked, failed,
+        elapsed_s, msgs_per_s, ack_latency_avg_s and ack_latency_max_s.
+        """
         qos = self.config["publish_qos"]
-        self.mqttc.publish(topic, message, qos=qos)
+        if max_inflight == None:
+            max_inflight = self.config["max_inflight"] if "max_inflight" in self.config else 20
+        if timeout == None:
+            timeout = self.config["publish_timeout_s"] if "publish_timeout_s" in self.config else 10
+
+        results = []
+        inflight = {}   # mid -> result dict, waiting for its ack
+
+        def collect(wait_for_one):
+            # move acked messages out of 'inflight'; called with ack_cond held
+            deadline = time.monotonic() + timeout
+            while inflight:
+                for mid in [mid for mid in inflight if mid in self.acked]:
+                    result = inflight.pop(mid)
+                    ack_time, reason_code = self.acked.pop(mid)
+                    result["acked"] = not reason_code.is_failure
+                    result["rc"] = reason_code
+                    result["latency_s"] = ack_time - result.pop("sent")
+                    self.ack_seconds.observe(result["latency_s"])
+                    wait_for_one = False
+                self.inflight_count = len(inflight)
+                remaining = deadline - time.monotonic()
+                if not wait_for_one or remaining <= 0:
+                    break
+                self.ack_cond.wait(remaining)
+            return wait_for_one
+
+        with self.ack_cond:
+            self.tracking_acks = True
+            self.acked.clear()
+        start = time.monotonic()
+        try:
+            messages = iter(messages)
+            for topic, payload in messages:
+                with self.ack_cond:
+                    if len(inflight) >= max_inflight and collect(True):
+                        self.logger.warning(f"[publish_many] no ack within {timeout}s, "
+                                            f"{len(inflight)} messages in flight")
+                        # the rest is not sent, but still counts as failed
+                        for topic, payload in itertools.chain([(topic, payload)], messages):
+                            results.append({"topic": topic, "mid": None, "rc": None,
+                                            "acked": False, "queued": False, "latency_s": None})
+                        break
+                sent = time.monotonic()
+                info = self.mqttc.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+                self.msgs_published.labels(topic).inc()
+                self.bytes_published.labels(topic).inc(len(payload))
+                result = {"topic": topic, "mid": info.mid, "rc": info.rc,
+                          "acked": False, "queued": info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0,
+                          "latency_s": None}
+                results.append(result)
+                if result["queued"]:
+                    self.logger.warning(f"[publish_many] not connected, {topic} is queued until reconnect")
+                elif info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    self.logger.error(f"[publish_many] publish to {topic} failed: {mqtt.error_string(info.rc)}")
+                elif qos == 0:
+                    result["acked"] = True
+                else:
+                    result["sent"] = sent
+                    with self.ack_cond:
+                        inflight[info.mid] = result
+                        self.inflight_count = len(inflight)
+
+            with self.ack_cond:
+                while inflight and not collect(True):
+                    pass
+                for result in inflight.values():
+                    result.pop("sent")
+        finally:
+            with self.ack_cond:
+                self.tracking_acks = False
+                self.acked.clear()
+                self.inflight_count = 0
+
+        elapsed_s = time.monotonic() - start
+        latencies = [r["latency_s"] for r in results if r["latency_s"] != None]
+        acked = sum(1 for r in results if r["acked"])
+        self.publish_failures.inc(len(results) - acked)
+        stats = {"count": len(results),
+                 "acked": acked,
+                 "failed": len(results) - acked,
+                 "elapsed_s": elapsed_s,
+                 "msgs_per_s": len(results) / elapsed_s if elapsed_s > 0 else 0.0,
+                 "ack_latency_avg_s": sum(latencies) / len(latencies) if latencies else None,
+                 "ack_latency_max_s": max(latencies) if latencies else None}
+        self.logger.info(f"[publish_many] {acked}/{len(results)} acked in {elapsed_s:.3f}s "
+                         f"({stats['msgs_per_s']:.1f} msgs/s)")
+        return results, stats
                 
+    def enqueue(self, topic, message, retain=False, properties=None):
+        # writes to the outbox, replacing any unsent message for 'topic'
+        content_type = getattr(properties, "ContentType", None) if properties != None else None
+        payload_format = getattr(properties, "PayloadFormatIndicator", None) if properties != None else None
+        self.outbox.put(topic, message, retain, content_type, payload_format)
+        with self.drain_cond:
+            self.drain_wanted = True
+            self.drain_cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits up to 'timeout' seconds for the outbox to be sent and
+        acknowledged. Returns True once it is empty; undelivered messages
+        stay in the outbox for the next connection (or the next run).
+        """
+        with self.drain_cond:
+            return self.drain_cond.wait_for(lambda: len(self.outbox) == 0, timeout)
+
+    def _drain(self):
+        # sends the outbox in batches of drain_batch_size while connected,
+        # retrying what was not acknowledged every drain_retry_s
+        while True:
+            with self.drain_cond:
+                self.drain_cond.wait_for(lambda: self.stopping or (self.connected and self.drain_wanted),
+                                         self.drain_retry_s)
+                if self.stopping:
+                    return
+                if not self.connected:
+                    continue
+                self.drain_wanted = False
+
+            batch = self.outbox.pending(self.drain_batch_size)
+            if not batch:
+                continue
+            # publish_many sends one retain flag and property set per call
+            groups = {}
+            for row in batch:
+                groups.setdefault((row[3], row[4], row[5]), []).append(row)
+            delivered = []
+            for (retain, content_type, payload_format), rows in groups.items():
+                properties = None
+                if content_type != None or payload_format != None:
+                    properties = Properties(PacketTypes.PUBLISH)
+                    if content_type != None:
+                        properties.ContentType = content_type
+                    if payload_format != None:
+                        properties.PayloadFormatIndicator = payload_format
+                results, _ = self.publish_many(((row[0], row[2]) for row in rows), retain=bool(retain),
+                                               properties=properties)
+                delivered.extend((row[0], row[1]) for row, result in zip(rows, results) if result["acked"])
+            self.outbox.remove(delivered)
+            if len(delivered) < len(batch):
+                self.logger.warning(f"[outbox] {len(batch) - len(delivered)} of {len(batch)} messages "
+                                    f"not delivered, retrying in {self.drain_retry_s}s")
+
+            with self.drain_cond:
+                # a full batch went through, so there may be more waiting
+                if len(delivered) == len(batch) == self.drain_batch_size:
+                    self.drain_wanted = True
+                self.drain_cond.notify_all()
+
     def disconnect(self):
-        self.mqttc.disconnect()
\ No newline at end of file
+        try:
+            self.aclient.run_threadsafe(self.aclient.disconnect(timeout=self.aclient.connect_timeout_s))
+        except asyncio.TimeoutError:
+            self.logger.warning("[disconnect] timed out")
\ No newline at end of file
@@ -0,0 +1,129 @@
+from collections import deque
+from threading import Lock, Condition
+
+class Route(object):
+    """
+    One registered topic filter. Matching records are passed to 'handler'
+    (on the MQTT network thread, so it should be quick) and/or queued for a
+    consumer thread to take with get()/get_all(). The queue holds at most
+    'queue_size' records; when a consumer falls behind the oldest are
+    dropped and counted in 'dropped'. queue_size 0 means no queue.
+    """
+
+    def __init__(self, topic_filter, handler=None, queue_size=1000, order=0):
+        self.topic_filter = topic_filter
+        self.handler = handler
+        self.order = order
+        self.queue = deque(maxlen=queue_size) if queue_size > 0 else None
+        self.queue_cond = Condition(Lock())
+        self.dispatched = 0
+        self.dropped = 0
+
+    def dispatch(self, record):
+        self.dispatched += 1
+        if self.handler != None:
+            self.handler(record)
+        if self.queue != None:
+            with self.queue_cond:
+                if len(self.queue) == self.queue.maxlen:
+                    self.dropped += 1
+                self.queue.append(record)
+                self.queue_cond.notify()
+
+    def get(self, timeout=None):
+        # oldest queued record, waiting up to 'timeout' seconds; None if none came
+        with self.queue_cond:
+            if not self.queue_cond.wait_for(lambda: len(self.queue) > 0, timeout):
+                return None
+            return self.queue.popleft()
+
+    def get_all(self):
+        # every queued record, oldest first, without waiting
+        with self.queue_cond:
+            records = list(self.queue)
+            self.queue.clear()
+        return records
+
+class _Node(object):
+    __slots__ = ("children", "routes")
+
+    def __init__(self):
+        self.children = {}
+        self.routes = []
+
+class TopicRouter(object):
+    """
+    Topic filters in a trie keyed by topic level, so matching a topic walks
+    at most one branch per '+'/'#' per level rather than testing every
+    filter. match() results are cached per topic (topics repeat); the cache
+    is cleared when routes change or it reaches 'cache_size' topics.
+    """
+
+    def __init__(self, cache_size=10000):
+        self.root = _Node()
+        self.lock = Lock()
+        self.cache = {}
+        self.cache_size = cache_size
+        self.route_count = 0
+
+    def add_route(self, topic_filter, handler=None, queue_size=1000):
+        route = Route(topic_filter, handler, queue_size)
+        with self.lock:
+            node = self.root
+            for level in topic_filter.split("/"):
+                node = node.children.setdefault(level, _Node())
+            route.order = self.route_count
+            self.route_count += 1
+            node.routes.append(route)
+            self.cache = {}
+        return route
+
+    def remove_route(self, route):
+        with self.lock:
+            node = self.root
+            for level in route.topic_filter.split("/"):
+                node = node.children.get(level)
+                if node == None:
+                    return
+            if route in node.routes:
+                node.routes.remove(route)
+            self.cache = {}
+
+    def match(self, topic):
+        """
+        Returns the routes whose filter matches 'topic', in the order they
+        were added.
+        """
+        routes = self.cache.get(topic)
+        if routes != None:
+            return routes
+        levels = topic.split("/")
+        routes = []
+        with self.lock:
+            self._match(self.root, levels, 0, routes, topic.startswith("$"))
+            routes.sort(key=lambda route: route.order)
+            if len(self.cache) >= self.cache_size:
+                self.cache = {}
+            self.cache[topic] = routes
+        return routes
+
+    def _match(self, node, levels, depth, routes, system_topic):
+        # wildcards at the first level do not match $SYS style topics
+        wildcards = not (depth == 0 and system_topic)
+        if wildcards and "#" in node.children:
+            routes.extend(node.children["#"].routes)
+        if depth == len(levels):
+            routes.extend(node.routes)
+            return
+        child = node.children.get(levels[depth])
+        if child != None:
+            self._match(child, levels, depth + 1, routes, system_topic)
+        if wildcards and "+" in node.children:
+            self._match(node.children["+"], levels, depth + 1, routes, system_topic)
+
+    def dispatch(self, record):
+        # hands 'record' to every matching route and returns how many matched
+        routes = self.match(record.topic)
+        for route in routes:
+            route.dispatch(record)
+        return len(routes)
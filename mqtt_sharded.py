@@ -0,0 +1,169 @@
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+from mqtt_client import MqttClient
+from mqtt_config import ConfigError
+
+# subscription identifier of the plain subscriptions a shared shard makes
+# to pick up retained messages
+RETAINED_SUB_ID = 1
+
+class _Shard(MqttClient):
+    """
+    One connection of a ShardedMqttClient. Its callbacks are the normal
+    MqttClient ones, but received records are decoded in this connection's
+    network thread and go into the owner's store. 'retained_topics' are
+    also subscribed to without a share group after each connect, for their
+    retained messages only, and unsubscribed again once the SUBACK is in.
+    """
+
+    def __init__(self, owner, config, logger, retained_topics=()):
+        super().__init__(config, logger, metrics=owner.metrics)
+        self.owner = owner
+        self.journal = owner.journal
+        # routes and filter labels are the owner's
+        self.router = owner.router
+        self.subscriptions = owner.subscriptions
+        self.retained_topics = list(retained_topics)
+        self.retained_mid = None
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        super().on_connect(client, userdata, flags, rc, properties)
+        if self.retained_topics and not rc.is_failure:
+            sub_properties = Properties(PacketTypes.SUBSCRIBE)
+            sub_properties.SubscriptionIdentifier = RETAINED_SUB_ID
+            self.logger.info(f"[on_connect] subscribing for retained messages: {self.retained_topics}")
+            _, self.retained_mid = client.subscribe([(topic, 1) for topic in self.retained_topics],
+                                                    properties=sub_properties)
+
+    def on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
+        super().on_subscribe(client, userdata, mid, granted_qos, properties)
+        if mid == self.retained_mid:
+            # the broker sends the retained messages right after the SUBACK,
+            # ahead of anything it reads from us next, so unsubscribing now
+            # keeps them and stops the live stream from arriving twice
+            self.retained_mid = None
+            self.logger.info(f"[on_subscribe] retained messages requested, unsubscribing: {self.retained_topics}")
+            client.unsubscribe(self.retained_topics)
+
+    def on_message(self, client, userdata, msg):
+        # live messages that reach the plain subscriptions before the
+        # UNSUBACK are delivered by the share group too; keep only the
+        # retained ones
+        if self.retained_topics and not msg.retain and msg.properties != None and \
+                RETAINED_SUB_ID in getattr(msg.properties, "SubscriptionIdentifier", ()):
+            return
+        super().on_message(client, userdata, msg)
+
+    def start(self):
+        # only the connection; the owner starts and stops the journal
+        self.aclient.run_threadsafe(self.aclient.connect(retry=True), wait=False)
+
+    def stop(self):
+        self.aclient.run_threadsafe(self.aclient.close())
+        self.loop_thread.stop()
+
+    def _add_record(self, record):
+        # decode here so the shards' loop threads do it side by side and
+        # readers of the merged store get decoded records
+        self.decode_records([record])
+        self.owner._add_record(record)
+
+class ShardedMqttClient(MqttClient):
+    """
+    MqttClient that receives over several connections, to one broker or to
+    several brokers of a cluster, and merges everything into a single store,
+    so readers use the same get_msgs()/get_changed_since()/wait_for_msgs()
+    as with one connection.
+
+    Config:
+      brokers       list of {"hivemq_url", "hivemq_port"}, default the
+                    hivemq_url/hivemq_port of the config
+      connections   number of connections, spread round robin over the
+                    brokers (default one per broker)
+      share_group   with a group name every connection subscribes to every
+                    topic as $share/<group>/<topic> and the broker balances
+                    messages between them; without one the topic_list is
+                    split between the connections instead. Brokers do not
+                    send retained messages to shared subscriptions, so on
+                    each connect the first connection also subscribes to
+                    each topic directly (with a subscription identifier)
+                    and unsubscribes once the SUBACK arrives, keeping only
+                    the retained messages it got in between.
+
+    Payloads are decoded by the connection that received them, in its
+    event loop thread, rather than by whoever reads the store.
+    """
+
+    def __init__(self, config, logger, metrics=None):
+        super().__init__(config, logger, metrics=metrics)
+        brokers = config["brokers"] if "brokers" in config and config["brokers"] else \
+            [{"hivemq_url": config["hivemq_url"], "hivemq_port": config["hivemq_port"]}]
+        connections = config["connections"] if "connections" in config and config["connections"] != None else len(brokers)
+        if connections < 1:
+            raise ConfigError(f"connections must be at least 1, not {connections}")
+        share_group = config["share_group"] if "share_group" in config else None
+        topic_list = config["topic_list"]
+
+        self.shards = []
+        for index in range(connections):
+            shard_config = dict(config, **brokers[index % len(brokers)])
+            shard_config["client_id"] = f"{config['client_id']}-{index}"
+            shard_config["journal_dir"] = None
+            retained_topics = ()
+            if share_group:
+                shard_config["topic_list"] = [f"$share/{share_group}/{topic}" for topic in topic_list]
+                if index == 0:
+                    retained_topics = topic_list
+            else:
+                shard_config["topic_list"] = topic_list[index::connections]
+                if not shard_config["topic_list"]:
+                    continue
+            self.shards.append(_Shard(self, shard_config, logger, retained_topics))
+        if not self.shards:
+            raise ConfigError("topic_list is empty, there is nothing to subscribe to")
+
+        # the shards registered their own gauges; point them back at the merged view
+        self.metrics.gauge("mqtt_store_messages", "Messages held in the store").set_function(lambda: len(self.msg_store))
+        self.metrics.gauge("mqtt_topics", "Topics in the latest-value index").set_function(lambda: len(self.latest))
+        self.metrics.gauge("mqtt_connected", "1 while connected to the broker").set_function(
+            lambda: sum(shard.connected for shard in self.shards))
+
+    def setup(self):
+        for shard in self.shards:
+            shard.setup()
+        self.mqttc = self.shards[0].mqttc
+
+    def connect(self):
+        for shard in self.shards:
+            shard.connect()
+
+    def start(self):
+        if self.journal != None:
+            self.journal.start()
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+        if self.journal != None:
+            self.journal.stop()
+
+    def disconnect(self):
+        for shard in self.shards:
+            shard.disconnect()
+
+    def get_connection_stats(self):
+        shard_stats = [shard.get_connection_stats() for shard in self.shards]
+        return {"connected": sum(stats["connected"] for stats in shard_stats),
+                "connections": len(self.shards),
+                "disconnect_count": sum(stats["disconnect_count"] for stats in shard_stats),
+                "disconnected_s": sum(stats["disconnected_s"] for stats in shard_stats),
+                "msgs_since_recovery": self.msgs_since_recovery,
+                "shards": shard_stats}
+
+    def get_callback_stats(self):
+        stats = super().get_callback_stats()
+        stats["on_message_max_s"] = max(shard.callback_time_max_s for shard in self.shards)
+        return stats
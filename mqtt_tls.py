@@ -0,0 +1,91 @@
+import ssl
+import time
+from threading import Lock
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    SSLContext that remembers the last TLS session per server and offers it
+    when wrapping the next socket to that server, so reconnects can do an
+    abbreviated (resumed) handshake instead of a full one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.sessions = {}
+        self.sessions_lock = Lock()
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session == None:
+            with self.sessions_lock:
+                session = self.sessions.get(server_hostname)
+        return super().wrap_socket(sock, *args, server_hostname=server_hostname,
+                                   session=session, **kwargs)
+
+    def save_session(self, sock, server_hostname):
+        # call once the connection is up; with TLS 1.3 the session ticket only
+        # arrives after the handshake, so right after wrap_socket is too early
+        session = getattr(sock, "session", None)
+        if session != None:
+            with self.sessions_lock:
+                self.sessions[server_hostname] = session
+
+_contexts = {}
+_contexts_lock = Lock()
+
+def get_ssl_context(ca_file=None):
+    """
+    Returns the process-wide client context shared by every MQTT connection
+    that trusts the same CA, creating it on first use. With no 'ca_file' the
+    system's default CA certificates are trusted.
+    """
+    with _contexts_lock:
+        if ca_file not in _contexts:
+            context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            if ca_file == None:
+                context.load_default_certs()
+            else:
+                context.load_verify_locations(cafile=ca_file)
+            _contexts[ca_file] = context
+        return _contexts[ca_file]
+
+def session_reused(sock):
+    # True/False for TLS sockets, None for plain TCP
+    return getattr(sock, "session_reused", None)
+
+class ConnectTimer(object):
+    """
+    Enables TLS on a paho client (unless the config has use_tls false) and
+    times each connect and reconnect from socket open to CONNACK, logging
+    whether the TLS session was resumed.
+    """
+
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.ssl_context = None
+        self.connect_started = None
+        self.connect_time_s = None
+        self.tls_session_reused = None
+
+    def install(self, mqttc):
+        mqttc.on_pre_connect = self.on_pre_connect
+        # share one context (and its saved sessions) between all connections
+        # so reconnects can resume
+        use_tls = self.config["use_tls"] if "use_tls" in self.config else True
+        if use_tls:
+            self.ssl_context = get_ssl_context(self.config["tls_ca_file"] if "tls_ca_file" in self.config else None)
+            mqttc.tls_set_context(self.ssl_context)
+
+    def on_pre_connect(self, client, userdata):
+        # called by paho before every connect and reconnect attempt
+        self.connect_started = time.monotonic()
+
+    def connected(self, client):
+        # call from on_connect
+        sock = client.socket()
+        self.connect_time_s = time.monotonic() - self.connect_started
+        self.tls_session_reused = session_reused(sock)
+        if self.ssl_context != None:
+            self.ssl_context.save_session(sock, self.config["hivemq_url"])
+        self.logger.info(f"[on_connect] connected in {self.connect_time_s * 1000:.1f} ms, "
+                         f"TLS session resumed: {self.tls_session_reused}")
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import socket
+import threading
+import time
+
+import pytest
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.reasoncodes import ReasonCode
+
+from local_broker import LocalBroker
+from mqtt_async_client import AsyncMqttClient
+from mqtt_client import MqttClient
+from mqtt_publisher import MqttPublisher
+
+def make_config(port, **config):
+    return dict({"name": "test", "client_id": "test-async", "client_username": "user", "client_pw": "pw",
+                 "hivemq_url": "127.0.0.1", "hivemq_port": port, "use_tls": False, "clean_start": True,
+                 "topic_list": [], "subscribe_qos": 1, "publish_qos": 1,
+                 "reconnect_min_delay_s": 0.05, "reconnect_max_delay_s": 0.1}, **config)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def drop_connections(broker):
+    # the broker closes every client connection, as if it went away
+    done = threading.Event()
+    def close():
+        for session in list(broker.sessions):
+            session.writer.close()
+        done.set()
+    broker.loop.call_soon_threadsafe(close)
+    assert done.wait(5)
+
+async def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.02)
+
+@pytest.fixture
+def broker():
+    broker = LocalBroker("127.0.0.1", 0)
+    broker.start()
+    yield broker
+    broker.stop()
+
+class FakePaho(object):
+    # just what on_connect touches
+    def socket(self):
+        return None
+
+def test_reconnect_backoff_stays_within_bounds():
+    client = AsyncMqttClient(make_config(1883, reconnect_min_delay_s=1, reconnect_max_delay_s=8),
+                             logging.getLogger("test"))
+    delays = [client.next_reconnect_delay() for _ in range(12)]
+    assert all(1 <= delay <= 8 for delay in delays)
+    # attempt n waits at most min * 2**n
+    assert all(delay <= 2 ** attempt for attempt, delay in enumerate(delays))
+    paho = FakePaho()
+    client.connect_timer.on_pre_connect(paho, None)
+    client.on_connect(paho, None, {}, ReasonCode(PacketTypes.CONNACK, "Success"))
+    assert client.reconnect_attempt == 0
+    assert client.next_reconnect_delay() <= 1
+
+def test_subscribe_publish_and_receive(broker):
+    async def run():
+        client = AsyncMqttClient(make_config(broker.port), logging.getLogger("test"))
+        await client.connect(timeout=5)
+        await client.subscribe("ip/#", timeout=5)
+        await client.publish("ip/a", b"hello", timeout=5)
+        msg = await asyncio.wait_for(client.messages().__anext__(), 5)
+        assert (msg.topic, msg.payload) == ("ip/a", b"hello")
+        await client.disconnect(timeout=5)
+    asyncio.run(run())
+
+def test_drop_fails_waiters_and_reconnects(broker):
+    async def run():
+        client = AsyncMqttClient(make_config(broker.port, topic_list=["ip/#"]), logging.getLogger("test"))
+        await client.connect(timeout=5)
+        await wait_until(lambda: len(broker.sessions) == 1 and next(iter(broker.sessions)).subscriptions)
+        # an acknowledgement that will never come
+        pending = client._wait_for_mid(12345)
+        drop_connections(broker)
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(pending, 5)
+        # reconnected and subscribed again in the background
+        await wait_until(lambda: client.mqttc.is_connected() and broker.sessions and
+                         next(iter(broker.sessions)).subscriptions)
+        await client.publish("ip/b", b"again", timeout=5)
+        msg = await asyncio.wait_for(client.messages().__anext__(), 5)
+        assert msg.topic == "ip/b"
+        await client.disconnect(timeout=5)
+        assert client._reconnect_task == None
+    asyncio.run(run())
+
+def test_connect_failure_raises_without_retry():
+    async def run():
+        client = AsyncMqttClient(make_config(free_port()), logging.getLogger("test"))
+        with pytest.raises(OSError):
+            await client.connect(timeout=5)
+    asyncio.run(run())
+
+def test_connect_with_retry_waits_for_the_broker():
+    port = free_port()
+    broker = LocalBroker("127.0.0.1", port)
+    async def run():
+        client = AsyncMqttClient(make_config(port), logging.getLogger("test"))
+        connecting = asyncio.ensure_future(client.connect(timeout=5, retry=True))
+        await asyncio.sleep(0.3)
+        assert not connecting.done() and client.reconnect_attempt > 0
+        await asyncio.get_running_loop().run_in_executor(None, broker.start)
+        assert not (await connecting).is_failure
+        await client.disconnect(timeout=5)
+    try:
+        asyncio.run(run())
+    finally:
+        broker.stop()
+
+def test_socket_close_after_the_loop_closed():
+    loop = asyncio.new_event_loop()
+    client = AsyncMqttClient(make_config(1883), logging.getLogger("test"), loop=loop)
+    loop.close()
+    # eg. paho closing its socket at interpreter shutdown
+    client.on_socket_close(None, None, None)
+    client.on_socket_unregister_write(None, None, None)
+
+def test_sync_clients_reconnect_and_stop_their_loop_threads(broker):
+    logger = logging.getLogger("test")
+    subscriber = MqttClient(make_config(broker.port, client_id="test-sub", topic_list=["ip/#"],
+                                        msg_store_size=10), logger)
+    publisher = MqttPublisher(make_config(broker.port, client_id="test-pub", publish_timeout_s=2), logger)
+    subscriber.setup()
+    subscriber.connect()
+    subscriber.start()
+    publisher.setup()
+    publisher.connect()
+    publisher.start()
+    try:
+        asyncio.run(wait_until(lambda: sum(bool(session.subscriptions) for session in broker.sessions) == 1))
+        publisher.publish_many([("ip/a", b"1")])
+        assert subscriber.wait_for_msgs(0, timeout=5)
+
+        drop_connections(broker)
+        asyncio.run(wait_until(lambda: subscriber.connected and publisher.connected and
+                               sum(bool(session.subscriptions) for session in broker.sessions) == 1))
+        results, _ = publisher.publish_many([("ip/b", b"2")])
+        assert results[0]["acked"]
+        asyncio.run(wait_until(lambda: subscriber.msg_seq == 2))
+        assert subscriber.get_connection_stats()["disconnect_count"] == 1
+    finally:
+        publisher.disconnect()
+        publisher.stop()
+        subscriber.disconnect()
+        subscriber.stop()
+    assert not publisher.loop_thread.thread.is_alive() and publisher.loop_thread.loop.is_closed()
+    assert not subscriber.loop_thread.thread.is_alive() and subscriber.loop_thread.loop.is_closed()
@@ -0,0 +1,60 @@
+import pytest
+
+from mqtt_codec import CODECS, STRUCT_HDR, decode_payload, get_codec, codec_id, codec_for
+
+INTERFACES = {"eth0": {"ipv4": ["10.0.0.2"], "ipv6": ["fe80::1"]},
+              "lo": {"ipv4": ["127.0.0.1"], "ipv6": ["::1"]}}
+
+@pytest.mark.parametrize("name", ["json", "msgpack", "struct"])
+def test_round_trip(name):
+    if name == "msgpack":
+        pytest.importorskip("msgpack")
+    codec = get_codec(name)
+    text, value = decode_payload(codec.encode(1700000000.25, INTERFACES), codec.content_type)
+    assert value["interfaces"] == INTERFACES
+    assert value["ip_address"] == "10.0.0.2"
+    assert value["timestamp_ms"] == 1700000000250
+    assert '"timestamp_ms":1700000000250' in text
+
+def test_codec_ids():
+    for codec in CODECS:
+        assert codec_for(codec.content_type) is codec
+        assert CODECS[codec_id(codec.content_type)] is codec
+    assert codec_id(None) == 0
+    with pytest.raises(ValueError):
+        get_codec("xml")
+
+@pytest.mark.parametrize("payload", [
+    b"",
+    b"\x01",
+    STRUCT_HDR.pack(2, 0, 0),                      # unknown version
+    STRUCT_HDR.pack(1, 0, 1) + b"\x05eth",          # truncated name
+    STRUCT_HDR.pack(1, 0, 1) + b"\x00\x01\x00",     # missing address
+    STRUCT_HDR.pack(1, 2 ** 64 - 1, 0),             # timestamp out of range
+])
+def test_struct_malformed(payload):
+    with pytest.raises(ValueError):
+        get_codec("struct").decode(payload)
+
+def test_msgpack_malformed():
+    msgpack = pytest.importorskip("msgpack")
+    codec = get_codec("msgpack")
+    for value in [5, [1, 2], {"a": 1},
+                  {"timestamp_ms": "x", "interfaces": {}},
+                  {"timestamp_ms": True, "interfaces": {}},
+                  {"timestamp_ms": 1, "interfaces": []},
+                  {"timestamp_ms": 1, "interfaces": {"eth0": {"ipv4": [1], "ipv6": []}}},
+                  {"timestamp_ms": 1, "interfaces": {}, "ip_address": 5},
+                  {"timestamp_ms": 10 ** 18, "interfaces": {}}]:
+        with pytest.raises(ValueError):
+            codec.decode(msgpack.packb(value))
+    for payload in [b"\xc1", b"\x92\x01", b"\x81\x91\x01\x01"]:
+        with pytest.raises(ValueError):
+            codec.decode(payload)
+
+def test_text_payload_malformed():
+    with pytest.raises(ValueError):
+        decode_payload(b"\xff", None)
+    with pytest.raises(ValueError):
+        decode_payload(b"{", "application/json")
+    assert decode_payload(b"1", None) == ("1", 1)
@@ -0,0 +1,50 @@
+import json
+import os
+
+import pytest
+
+from mqtt_config import ConfigError, load_config, validate_config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def generic_config(name):
+    with open(os.path.join(ROOT, name)) as config_file:
+        return json.load(config_file)
+
+def test_generic_configs_are_valid():
+    assert validate_config(generic_config("client_config_generic.json"), "client") == ([], [])
+    assert validate_config(generic_config("pub_config_generic.json"), "publisher") == ([], [])
+
+@pytest.mark.parametrize("changes, message", [
+    ({"hivemq_port": True}, "'hivemq_port' must be int"),
+    ({"hivemq_port": 70000}, "'hivemq_port' must be at most 65535"),
+    ({"subscribe_qos": 3}, "'subscribe_qos' must be one of 0, 1, 2"),
+    ({"client_id": None}, "'client_id' must not be null"),
+    ({"reconnect_min_delay_s": 0}, "'reconnect_min_delay_s' must be greater than 0"),
+    ({"reconnect_min_delay_s": 5, "reconnect_max_delay_s": 2},
+     "'reconnect_min_delay_s' (5) must not be greater than 'reconnect_max_delay_s' (2)"),
+])
+def test_client_errors(changes, message):
+    errors, unknown = validate_config(dict(generic_config("client_config_generic.json"), **changes), "client")
+    assert len(errors) == 1 and errors[0].startswith(message)
+
+def test_missing_and_unknown_keys():
+    config = generic_config("pub_config_generic.json")
+    del config["ifname"]
+    config["outbox_retry_s"] = 0
+    config["publish_qoss"] = 1
+    errors, unknown = validate_config(config, "publisher")
+    assert errors == ["'ifname' is missing", "'outbox_retry_s' must be greater than 0, not 0"]
+    assert unknown == ["publish_qoss"]
+    assert validate_config([], "publisher") == (["the config must be a JSON object"], [])
+
+def test_load_config(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text("{")
+    with pytest.raises(ConfigError, match="Error parsing"):
+        load_config(str(path), "client")
+    with pytest.raises(ConfigError, match="not found"):
+        load_config(str(tmp_path / "missing.json"), "client")
+    path.write_text(json.dumps(dict(generic_config("client_config_generic.json"), clean_start="yes")))
+    with pytest.raises(ConfigError, match="'clean_start' must be bool"):
+        load_config(str(path), "client")
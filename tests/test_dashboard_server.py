@@ -0,0 +1,77 @@
+import gzip
+import json
+import logging
+import http.client
+
+import pytest
+
+from dashboard_server import DashboardServer, accepts_gzip, etag_matches
+
+@pytest.fixture
+def dashboard():
+    server = DashboardServer("127.0.0.1", 0, logging.getLogger("test"), max_streams=1)
+    server.start()
+    server.update("<html>hosts</html>", {"hosts": ["a"]})
+    yield server
+    server.stop()
+
+def request(server, path, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", server.httpd.server_address[1], timeout=5)
+    connection.request("GET", path, headers=headers or {})
+    return connection, connection.getresponse()
+
+def test_etag_matches():
+    etag = '"abc"'
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('W/"abc"', etag)
+    assert etag_matches('"x", W/"abc"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"x"', etag)
+    assert not etag_matches(None, etag)
+
+def test_accepts_gzip():
+    assert accepts_gzip("gzip, deflate, br")
+    assert accepts_gzip("deflate;q=1, gzip;q=0.5")
+    assert accepts_gzip("*")
+    assert not accepts_gzip("gzip;q=0")
+    assert not accepts_gzip("gzip; q=0.0, *")
+    assert not accepts_gzip("*;q=0")
+    assert not accepts_gzip("identity")
+    assert not accepts_gzip(None)
+
+def test_page_revalidation_and_gzip(dashboard):
+    connection, response = request(dashboard, "/")
+    body = response.read()
+    etag = response.getheader("ETag")
+    assert response.status == 200 and body == b"<html>hosts</html>"
+    assert response.getheader("Content-Encoding") == None
+    for if_none_match in (etag, "W/" + etag, '"other", ' + etag, "*"):
+        connection, response = request(dashboard, "/", {"If-None-Match": if_none_match})
+        response.read()
+        assert response.status == 304
+    connection, response = request(dashboard, "/", {"If-None-Match": '"other"', "Accept-Encoding": "gzip"})
+    assert response.status == 200 and response.getheader("Content-Encoding") == "gzip"
+    assert gzip.decompress(response.read()) == b"<html>hosts</html>"
+    connection, response = request(dashboard, "/", {"Accept-Encoding": "gzip;q=0, deflate"})
+    assert response.read() == b"<html>hosts</html>"
+
+def test_hosts_json(dashboard):
+    connection, response = request(dashboard, "/api/hosts")
+    assert json.loads(response.read()) == {"hosts": ["a"]}
+    connection, response = request(dashboard, "/missing")
+    response.read()
+    assert response.status == 404
+
+def test_events_stream_and_limit(dashboard):
+    connection, response = request(dashboard, "/events")
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "text/event-stream"
+    assert response.readline() == b'data: {"hosts":["a"]}\n'
+    assert response.readline() == b"\n"
+    # max_streams is 1, so a second stream is turned away
+    other, refused = request(dashboard, "/events")
+    refused.read()
+    assert refused.status == 503
+    dashboard.update("<html>hosts</html>", {"hosts": ["a", "b"]})
+    assert response.readline() == b'data: {"hosts":["a","b"]}\n'
+    connection.close()
@@ -0,0 +1,82 @@
+import json
+import logging
+
+from mqtt_client import MqttClient, MqttRecord
+from host_registry import HostRegistry, parse_host_payload
+from mqtt_codec import get_codec
+
+CONFIG = {"name": "test", "topic_list": ["ip/#"], "client_id": "test", "client_username": "user",
+          "client_pw": "pw", "hivemq_url": "localhost", "hivemq_port": 1883, "clean_start": True,
+          "subscribe_qos": 1}
+
+def host_record(topic, timestamp_ms, ip_address="10.0.0.1", received=0):
+    payload = json.dumps({"timestamp_ms": timestamp_ms, "ip_address": ip_address}).encode()
+    return MqttRecord(topic, payload, 1, received, 0)
+
+def test_parse_host_payload():
+    assert parse_host_payload(host_record("ip/a", 5000)) == ("10.0.0.1", 5.0)
+    assert parse_host_payload(MqttRecord("ip/a", b" 10.0.0.9\n", 0, 0, 0)) == ("10.0.0.9", None)
+    assert parse_host_payload(MqttRecord("ip/a", b'{"timestamp_ms": "x"}', 0, 0, 0)) == (None, None)
+    assert parse_host_payload(MqttRecord("ip/a", b'{"timestamp_ms": true}', 0, 0, 0)) == (None, None)
+
+def test_published_time_is_zone_independent():
+    # every codec carries timestamp_ms, which wins over the local time text
+    payload = get_codec("json").encode(1700000000.5, {})
+    assert parse_host_payload(MqttRecord("ip/a", payload, 0, 0, 0))[1] == 1700000000.5
+    payload = b'{"timestamp": "2023-11-14 22:13:20+0000"}'
+    assert parse_host_payload(MqttRecord("ip/a", payload, 0, 0, 0))[1] == 1700000000
+    payload = b'{"timestamp": "2023-11-14 23:13:20+01:00"}'
+    assert parse_host_payload(MqttRecord("ip/a", payload, 0, 0, 0))[1] == 1700000000
+
+def test_page_after_removals():
+    registry = HostRegistry(ttl_s=10, max_hosts=3)
+    for index, topic in enumerate(["ip/d", "ip/b", "ip/c", "ip/a", "ip/e"]):
+        registry.update(host_record(topic, index * 1000))
+    assert [entry.topic for entry in registry.page()[0]] == ["ip/a", "ip/c", "ip/e"]
+    registry.expire(now=12.5)
+    entries, total = registry.page(1, 5)
+    assert [entry.topic for entry in entries] == ["ip/e"] and total == 2
+
+def test_expire_and_page():
+    removed = []
+    registry = HostRegistry(ttl_s=10, stale_after_s=5, on_remove=removed.append)
+    for index, topic in enumerate(["ip/c", "ip/a", "ip/b"]):
+        assert registry.update(host_record(topic, index * 1000))
+    assert not registry.update(host_record("ip/c", 3000))
+    entries, total = registry.page(0, 2)
+    assert [entry.topic for entry in entries] == ["ip/a", "ip/b"] and total == 3
+    assert registry.is_stale(entries[0], now=7.5)
+    assert registry.expire(now=11.5) == 1
+    assert removed == ["ip/a"]
+    assert registry.expire(now=12.5) == 1
+    assert removed == ["ip/a", "ip/b"]
+    assert registry.get_stats(now=12.5)["hosts"] == 1
+
+def test_max_hosts_evicts_first_to_expire():
+    removed = []
+    registry = HostRegistry(ttl_s=10, max_hosts=2, on_remove=removed.append)
+    for index in range(4):
+        registry.update(host_record(f"ip/{index}", index * 1000))
+    assert removed == ["ip/0", "ip/1"]
+    assert len(registry) == 2
+
+def test_heap_stays_bounded():
+    registry = HostRegistry(ttl_s=10)
+    for index in range(1000):
+        registry.update(host_record(f"ip/{index % 10}", index))
+    assert registry.get_stats(now=0)["heap_size"] <= 2 * 10 + 64
+
+def test_removed_hosts_are_forgotten_by_the_client():
+    client = MqttClient(CONFIG, logging.getLogger("test"))
+    for index in range(3):
+        client._add_record(host_record(f"ip/{index}", index * 1000))
+    records, seq = client.get_changed_since(0)
+    registry = HostRegistry(ttl_s=10, on_remove=lambda topic: client.forget(topic, seq))
+    for record in records:
+        registry.update(record)
+    # republished after the cursor, so kept even though the registry lets go
+    client._add_record(host_record("ip/1", 1000))
+    assert registry.expire(now=11.5) == 2
+    assert list(client.latest) == ["ip/2", "ip/1"]
+    assert client.forget("ip/1")
+    assert not client.forget("ip/1")
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from IP_address_client import create_html, save_html_file
+
+def test_save_html_file_replaces_atomically(tmp_path):
+    path = tmp_path / "index.html"
+    save_html_file(str(path), "first")
+    save_html_file(str(path), "second")
+    assert path.read_text() == "second"
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    # no temp files left next to the page
+    assert os.listdir(tmp_path) == ["index.html"]
+
+def test_save_html_file_keeps_old_page_on_error(tmp_path):
+    path = tmp_path / "index.html"
+    save_html_file(str(path), "good")
+    with pytest.raises(TypeError):
+        save_html_file(str(path), None)
+    assert path.read_text() == "good"
+    assert os.listdir(tmp_path) == ["index.html"]
+
+def test_create_html_is_stable():
+    # the subscriber skips the write when the page text is unchanged
+    entries = ["ip/a: 10.0.0.1", "ip/b: 10.0.0.2"]
+    assert create_html(entries) == create_html(list(entries))
+    assert create_html(entries) != create_html(entries[:1])
+
+def test_create_html_list_size_and_escaping():
+    assert '<select size="1">' in create_html([])
+    assert '<select size="2">' in create_html(["a", "b"])
+    assert '<select size="30">' in create_html([str(index) for index in range(40)])
+    page = create_html(['ip/a: <b>"x"</b>'])
+    assert "<option>ip/a: &lt;b&gt;&quot;x&quot;&lt;/b&gt;</option>" in page
+    assert "Showing 1 of 5 hosts" in create_html(["a"], total=5)
+    assert "EventSource" in create_html(["a"], live=True)
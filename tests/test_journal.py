@@ -0,0 +1,61 @@
+import logging
+import os
+import struct
+
+from mqtt_journal import RECORD_HDR, MessageJournal
+
+def make_journal(path, **kwargs):
+    return MessageJournal(str(path), logging.getLogger("test"), flush_interval_s=0.01, **kwargs)
+
+def write(path, records, **kwargs):
+    journal = make_journal(path, **kwargs)
+    journal.start()
+    for timestamp, topic, payload, qos in records:
+        journal.append(topic, payload, qos, timestamp)
+    journal.stop()
+    return journal
+
+def test_record_format(tmp_path):
+    journal = write(tmp_path, [(1.5, "ip/a", b"hello", 1)])
+    [path] = journal.segments()
+    with open(path, "rb") as file:
+        data = file.read()
+    assert data == RECORD_HDR.pack(RECORD_HDR.size + 4 + 5, 1.5, 1, 4) + b"ip/a" + b"hello"
+    assert list(journal.replay()) == [(1.5, "ip/a", b"hello", 1)]
+
+def test_torn_tail_is_cut_off_on_start(tmp_path):
+    journal = write(tmp_path, [(1.0, "ip/a", b"one", 0)])
+    [path] = journal.segments()
+    # a crash in the middle of writing the next record
+    with open(path, "ab") as file:
+        file.write(RECORD_HDR.pack(RECORD_HDR.size + 4 + 100, 2.0, 0, 4) + b"ip/b" + b"partial")
+    assert list(journal.replay()) == [(1.0, "ip/a", b"one", 0)]
+    journal = write(tmp_path, [(3.0, "ip/c", b"three", 0)])
+    assert journal.segments() == [path]
+    assert list(journal.replay()) == [(1.0, "ip/a", b"one", 0), (3.0, "ip/c", b"three", 0)]
+
+def test_replay_time_bounds_across_segments(tmp_path):
+    records = [(float(second), f"ip/{second % 3}", bytes([second]) * 20, 0) for second in range(10)]
+    for record in records:
+        journal = write(tmp_path, [record], segment_size=100)
+    # two records per segment
+    assert len(journal.segments()) == 5
+    assert list(journal.replay()) == records
+    assert list(journal.replay(3.0, 6.0)) == records[3:7]
+    assert list(journal.replay(start_time=8.5)) == records[9:]
+    assert list(journal.replay(end_time=0.5)) == records[:1]
+
+def test_recover_finds_topics_in_older_segments(tmp_path):
+    write(tmp_path, [(1.0, "ip/a", b"a1", 0), (2.0, "ip/b", b"b1", 0)], segment_size=64)
+    write(tmp_path, [(3.0, "ip/b", b"b2", 0)], segment_size=64)
+    journal = write(tmp_path, [(4.0, "ip/c", b"c1", 0)], segment_size=64)
+    assert len(journal.segments()) > 1
+    assert journal.recover() == [(1.0, "ip/a", b"a1", 0), (3.0, "ip/b", b"b2", 0), (4.0, "ip/c", b"c1", 0)]
+
+def test_restarts_leave_no_empty_segments(tmp_path):
+    write(tmp_path, [(1.0, "ip/a", b"a1", 0)], max_segments=2)
+    for _ in range(5):
+        journal = write(tmp_path, [], max_segments=2)
+    assert len(journal.segments()) == 1
+    assert all(os.path.getsize(path) > 0 for path in journal.segments())
+    assert journal.recover() == [(1.0, "ip/a", b"a1", 0)]
@@ -0,0 +1,62 @@
+import urllib.request
+from threading import Thread
+
+from mqtt_metrics import MetricsRegistry, serve_metrics
+
+def test_exposition_text():
+    registry = MetricsRegistry()
+    received = registry.counter("msgs_total", "Messages received", ["filter"])
+    received.labels("ip/#").inc()
+    received.labels("ip/#").inc(2)
+    received.labels('a"b\\c\nd').inc()
+    registry.gauge("queue_depth", "Queued messages").set(7)
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value)
+    assert registry.render() == "\n".join([
+        "# HELP msgs_total Messages received",
+        "# TYPE msgs_total counter",
+        'msgs_total{filter="ip/#"} 3',
+        'msgs_total{filter="a\\"b\\\\c\\nd"} 1',
+        "# HELP queue_depth Queued messages",
+        "# TYPE queue_depth gauge",
+        "queue_depth 7",
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 3.65",
+        "latency_seconds_count 4",
+    ]) + "\n"
+
+def test_registry_returns_existing_metric_and_gauge_function():
+    registry = MetricsRegistry()
+    assert registry.counter("c", "C") is registry.counter("c", "C")
+    items = []
+    registry.gauge("items", "Items").set_function(lambda: len(items))
+    items.extend([1, 2])
+    assert "items 2\n" in registry.render()
+
+def test_counter_sums_threads():
+    registry = MetricsRegistry()
+    counter = registry.counter("c", "C")
+    threads = [Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.get() == 4000
+
+def test_serve_metrics():
+    registry = MetricsRegistry()
+    registry.counter("c", "C").inc()
+    httpd = serve_metrics(registry, "127.0.0.1", 0)
+    try:
+        url = f"http://127.0.0.1:{httpd.server_address[1]}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            assert response.read().decode() == registry.render()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
@@ -0,0 +1,94 @@
+import logging
+
+from mqtt_client import MqttClient, MqttRecord
+
+CONFIG = {"name": "test", "topic_list": ["ip/#"], "client_id": "test", "client_username": "user",
+          "client_pw": "pw", "hivemq_url": "localhost", "hivemq_port": 1883, "clean_start": True,
+          "subscribe_qos": 1, "msg_store_size": 4}
+
+def make_client(**config):
+    return MqttClient(dict(CONFIG, **config), logging.getLogger("test"))
+
+def add(client, topic, text):
+    client._add_record(MqttRecord(topic, text.encode(), 1, 0, 0))
+
+def test_get_msgs_since_reads_each_message_once():
+    client = make_client()
+    add(client, "ip/a", "1")
+    add(client, "ip/b", "2")
+    msgs, seq, missed = client.get_msgs_since(0)
+    assert msgs == ["ip/a: 1", "ip/b: 2"] and seq == 2 and missed == 0
+    assert client.get_msgs_since(seq) == ([], 2, 0)
+    add(client, "ip/a", "3")
+    assert client.get_msgs_since(seq) == (["ip/a: 3"], 3, 0)
+
+def test_get_msgs_since_counts_messages_that_wrapped_out():
+    client = make_client()
+    for index in range(10):
+        add(client, "ip/a", str(index))
+    # the store holds the newest 4; the other 6 fell off before being read
+    msgs, seq, missed = client.get_msgs_since(0)
+    assert msgs == [f"ip/a: {index}" for index in range(6, 10)]
+    assert seq == 10 and missed == 6
+    add(client, "ip/a", "10")
+    assert client.get_msgs_since(8) == (["ip/a: 8", "ip/a: 9", "ip/a: 10"], 11, 0)
+
+def test_get_msgs_truncates_to_the_newest():
+    client = make_client()
+    for index in range(6):
+        add(client, "ip/a", str(index))
+    assert client.get_msgs() == [f"ip/a: {index}" for index in range(2, 6)]
+    assert client.get_msgs(2) == ["ip/a: 4", "ip/a: 5"]
+    assert client.get_msgs(0) == []
+
+def test_get_changed_since_returns_latest_per_topic():
+    client = make_client()
+    add(client, "ip/a", "1")
+    add(client, "ip/b", "2")
+    add(client, "ip/a", "3")
+    records, seq = client.get_changed_since(0)
+    assert [str(record) for record in records] == ["ip/b: 2", "ip/a: 3"] and seq == 3
+    assert client.get_changed_since(seq) == ([], 3)
+    add(client, "ip/b", "4")
+    add(client, "ip/c", "5")
+    records, seq = client.get_changed_since(seq)
+    assert [str(record) for record in records] == ["ip/b: 4", "ip/c: 5"] and seq == 5
+    # the per-topic index is not bounded by the store size
+    for index in range(10):
+        add(client, f"ip/{index}", str(index))
+    assert len(client.get_changed_since(0)[0]) == 13
+
+class FakePaho(object):
+    # just what the connection callbacks touch
+    def __init__(self):
+        self.subscribed = []
+
+    def socket(self):
+        return None
+
+    def subscribe(self, topic, qos=0, properties=None):
+        self.subscribed.append(topic)
+
+def connack(client, paho, failure=False):
+    from paho.mqtt.packettypes import PacketTypes
+    from paho.mqtt.reasoncodes import ReasonCode
+    client.connect_timer.on_pre_connect(paho, None)
+    client.on_connect(paho, None, {}, ReasonCode(PacketTypes.CONNACK, "Not authorized" if failure else "Success"))
+
+def test_outages_are_counted_once():
+    client = make_client()
+    paho = FakePaho()
+    # failing to connect at startup is not a disconnect
+    client.on_connect_fail(paho, None)
+    connack(client, paho)
+    stats = client.get_connection_stats()
+    assert stats["disconnect_count"] == 0 and stats["disconnected_s"] == 0
+    assert client.reconnects.get() == 0
+    client.on_disconnect(paho, None, {}, 0)
+    client.on_connect_fail(paho, None)
+    client.on_disconnect(paho, None, {}, 0)
+    assert client.get_connection_stats()["disconnect_count"] == 1
+    connack(client, paho)
+    stats = client.get_connection_stats()
+    assert stats["connected"] and stats["disconnect_count"] == 1
+    assert client.reconnects.get() == 1
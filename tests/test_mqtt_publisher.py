@@ -0,0 +1,97 @@
+import logging
+import socket
+
+import pytest
+
+import IP_address_publisher
+from local_broker import LocalBroker
+from mqtt_publisher import MqttPublisher
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def make_publisher(port, **config):
+    config = dict({"name": "test", "client_id": "test-pub", "client_username": "user", "client_pw": "pw",
+                   "hivemq_url": "127.0.0.1", "hivemq_port": port, "use_tls": False,
+                   "topic_list": ["ip/test"], "publish_qos": 1, "ifname": "eth0",
+                   "publish_timeout_s": 2}, **config)
+    return MqttPublisher(config, logging.getLogger("test"))
+
+@pytest.fixture
+def broker():
+    broker = LocalBroker("127.0.0.1", 0)
+    broker.start()
+    yield broker
+    broker.stop()
+
+@pytest.fixture
+def publisher(broker):
+    publisher = make_publisher(broker.port, max_inflight=4)
+    publisher.setup()
+    publisher.connect()
+    publisher.start()
+    yield publisher
+    publisher.disconnect()
+    publisher.stop()
+
+@pytest.fixture
+def offline_publisher():
+    # nothing listens on the port, so paho keeps retrying in the background
+    publisher = make_publisher(free_port(), reconnect_min_delay_s=60)
+    publisher.setup()
+    publisher.connect(retry=True)
+    publisher.start()
+    yield publisher
+    publisher.disconnect()
+    publisher.stop()
+
+def test_publish_while_disconnected_is_queued(offline_publisher):
+    results, stats = offline_publisher.publish_many([("ip/a", b"1"), ("ip/b", b"2")])
+    assert [result["queued"] for result in results] == [True, True]
+    assert stats["failed"] == 2
+    # a daemon does not publish queued messages again; a one-shot run fails
+    logger = logging.getLogger("test")
+    assert IP_address_publisher.publish_message(offline_publisher, logger, ["ip/a"], b"1", True, wait=False)
+    assert not IP_address_publisher.publish_message(offline_publisher, logger, ["ip/a"], b"1", True)
+
+def test_publish_many_acks_everything_within_the_window(publisher):
+    window = []
+    publish = publisher.mqttc.publish
+    def counting_publish(*args, **kwargs):
+        window.append(publisher.inflight_count)
+        return publish(*args, **kwargs)
+    publisher.mqttc.publish = counting_publish
+
+    results, stats = publisher.publish_many((f"ip/{index}", b"x" * index) for index in range(50))
+    assert stats["count"] == 50 and stats["acked"] == 50 and stats["failed"] == 0
+    assert [result["topic"] for result in results] == [f"ip/{index}" for index in range(50)]
+    assert all(result["acked"] and result["latency_s"] >= 0 for result in results)
+    assert len(set(result["mid"] for result in results)) == 50
+    # never more than max_inflight unacknowledged when the next one goes out
+    assert len(window) == 50 and max(window) < 4
+    assert stats["ack_latency_max_s"] >= stats["ack_latency_avg_s"] > 0
+    assert publisher.publish_failures.get() == 0
+
+def test_publish_many_timeout_fails_unsent_and_unacked(publisher):
+    # acks arrive but are never recorded, so the window stays full
+    publisher.mqttc.on_publish = None
+    results, stats = publisher.publish_many([(f"ip/{index}", b"x") for index in range(6)],
+                                            max_inflight=2, timeout=0.2)
+    assert stats["count"] == 6 and stats["acked"] == 0 and stats["failed"] == 6
+    assert [result["mid"] != None for result in results] == [True, True, False, False, False, False]
+    assert all(result["latency_s"] == None and not result["queued"] for result in results)
+    assert publisher.publish_failures.get() == 6
+
+def test_publish_many_qos0_counts_as_acked(broker):
+    publisher = make_publisher(broker.port, publish_qos=0)
+    publisher.setup()
+    publisher.connect()
+    publisher.start()
+    try:
+        results, stats = publisher.publish_many([("ip/a", b"1"), ("ip/b", b"2")])
+        assert stats["acked"] == 2 and all(result["latency_s"] == None for result in results)
+    finally:
+        publisher.disconnect()
+        publisher.stop()
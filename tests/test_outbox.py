@@ -0,0 +1,34 @@
+from mqtt_outbox import Outbox
+
+def test_newest_message_per_topic(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    outbox.put("ip/a", "one")
+    outbox.put("ip/b", b"two", retain=True, content_type="application/msgpack", payload_format=0)
+    outbox.put("ip/a", "three")
+    pending = outbox.pending()
+    assert [(topic, payload) for topic, seq, payload, *rest in pending] == [("ip/b", b"two"), ("ip/a", b"three")]
+    assert pending[0][3:6] == (1, "application/msgpack", 0)
+    assert len(outbox) == 2
+    outbox.close()
+
+def test_remove_keeps_newer_messages(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"))
+    seq_a = outbox.put("ip/a", "old")
+    seq_b = outbox.put("ip/b", "sent")
+    # replaced while the first version was in flight
+    outbox.put("ip/a", "new")
+    outbox.remove([("ip/a", seq_a), ("ip/b", seq_b)])
+    assert [(topic, payload) for topic, seq, payload, *rest in outbox.pending()] == [("ip/a", b"new")]
+    outbox.close()
+
+def test_survives_reopen(tmp_path):
+    path = str(tmp_path / "spool" / "outbox.db")
+    outbox = Outbox(path)
+    outbox.put("ip/a", "one")
+    last_seq = outbox.put("ip/b", "two")
+    outbox.close()
+    outbox = Outbox(path)
+    assert len(outbox) == 2
+    assert outbox.put("ip/c", "three") > last_seq
+    assert len(outbox.pending(limit=1)) == 1
+    outbox.close()
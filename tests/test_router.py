@@ -0,0 +1,52 @@
+import random
+
+from paho.mqtt.client import topic_matches_sub
+
+from mqtt_client import MqttRecord
+from mqtt_router import TopicRouter
+
+LEVELS = ["a", "b", "c", "", "$SYS"]
+
+def random_topic(rng):
+    levels = [rng.choice(LEVELS) for _ in range(rng.randint(1, 4))]
+    # only the first level may start with $
+    return "/".join(levels[:1] + [level for level in levels[1:] if level != "$SYS"])
+
+def random_filter(rng):
+    levels = [rng.choice(LEVELS + ["+", "+"]) for _ in range(rng.randint(1, 4))]
+    if rng.random() < 0.3:
+        levels.append("#")
+    return "/".join(levels[:1] + [level for level in levels[1:] if level != "$SYS"])
+
+def test_match_agrees_with_paho():
+    rng = random.Random(1234)
+    router = TopicRouter()
+    filters = sorted(set(random_filter(rng) for _ in range(200)))
+    routes = [router.add_route(topic_filter) for topic_filter in filters]
+    for _ in range(2000):
+        topic = random_topic(rng)
+        expected = [route for route in routes if topic_matches_sub(route.topic_filter, topic)]
+        assert router.match(topic) == expected, topic
+
+def test_match_order_and_cache():
+    router = TopicRouter(cache_size=2)
+    hash_route = router.add_route("#")
+    exact = router.add_route("home/kitchen/temp")
+    plus = router.add_route("home/+/temp")
+    assert router.match("home/kitchen/temp") == [hash_route, exact, plus]
+    assert router.match("$SYS/broker") == []
+    router.match("home/hall/temp")
+    router.match("other")
+    router.remove_route(exact)
+    assert router.match("home/kitchen/temp") == [hash_route, plus]
+
+def test_route_queue_drops_oldest():
+    router = TopicRouter()
+    handled = []
+    route = router.add_route("ip/#", handler=handled.append, queue_size=2)
+    for topic in ("ip/a", "ip/b", "ip/c", "other"):
+        router.dispatch(MqttRecord(topic, b"", 0, 0, 0))
+    assert len(handled) == 3
+    assert [record.topic for record in route.get_all()] == ["ip/b", "ip/c"]
+    assert route.dropped == 1
+    assert route.get(timeout=0) == None
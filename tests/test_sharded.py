@@ -0,0 +1,100 @@
+import logging
+import time
+
+import pytest
+
+from local_broker import LocalBroker
+from mqtt_config import ConfigError
+from mqtt_publisher import MqttPublisher
+from mqtt_sharded import ShardedMqttClient
+
+def make_config(port, **config):
+    return dict({"name": "test", "client_id": "test-sub", "client_username": "user", "client_pw": "pw",
+                 "hivemq_url": "127.0.0.1", "hivemq_port": port, "use_tls": False,
+                 "clean_start": True, "topic_list": ["ip/a/#", "ip/b/#"], "subscribe_qos": 1,
+                 "msg_store_size": 100}, **config)
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+def subscriptions(broker):
+    return sorted(topic_filter for session in broker.sessions for topic_filter in session.subscriptions)
+
+@pytest.fixture
+def broker():
+    broker = LocalBroker("127.0.0.1", 0)
+    broker.start()
+    yield broker
+    broker.stop()
+
+@pytest.fixture
+def publisher(broker):
+    config = {"name": "test", "client_id": "test-pub", "client_username": "user", "client_pw": "pw",
+              "hivemq_url": "127.0.0.1", "hivemq_port": broker.port, "use_tls": False,
+              "topic_list": [], "publish_qos": 1, "publish_timeout_s": 2}
+    publisher = MqttPublisher(config, logging.getLogger("test"))
+    publisher.setup()
+    publisher.connect()
+    publisher.start()
+    yield publisher
+    publisher.disconnect()
+    publisher.stop()
+
+def run_client(client):
+    client.setup()
+    client.connect()
+    client.start()
+
+def stop_client(client):
+    client.disconnect()
+    client.stop()
+
+def records(client):
+    with client.mutex:
+        return list(client.msg_store)
+
+def topics(client):
+    return sorted(record.topic for record in records(client))
+
+def test_topic_list_is_split_and_merged(broker, publisher):
+    client = ShardedMqttClient(make_config(broker.port, connections=2), logging.getLogger("test"))
+    assert [shard.config["topic_list"] for shard in client.shards] == [["ip/a/#"], ["ip/b/#"]]
+    run_client(client)
+    try:
+        wait_until(lambda: len(subscriptions(broker)) == 2)
+        publisher.publish_many([("ip/a/1", b'{"n": 1}'), ("ip/b/1", b'{"n": 2}')])
+        wait_until(lambda: client.msg_seq == 2)
+        assert topics(client) == ["ip/a/1", "ip/b/1"]
+        assert client.latest.keys() == {"ip/a/1", "ip/b/1"}
+        # decoded by the shard that received it
+        assert all(record._json != None for record in records(client))
+        assert client.get_connection_stats()["connected"] == 2
+    finally:
+        stop_client(client)
+
+def test_share_group_loads_retained_then_unsubscribes(broker, publisher):
+    publisher.publish_many([("ip/a/old", b"retained")], retain=True)
+    client = ShardedMqttClient(make_config(broker.port, connections=2, share_group="g"), logging.getLogger("test"))
+    run_client(client)
+    try:
+        wait_until(lambda: client.msg_seq == 1)
+        # only the shared subscriptions are left once the plain ones were unsubscribed
+        wait_until(lambda: subscriptions(broker) == ["$share/g/ip/a/#"] * 2 + ["$share/g/ip/b/#"] * 2)
+        assert topics(client) == ["ip/a/old"]
+
+        publisher.publish_many([(f"ip/b/{index}", b"live") for index in range(10)])
+        wait_until(lambda: client.msg_seq == 11)
+        time.sleep(0.2)
+        assert client.msg_seq == 11
+        assert topics(client) == ["ip/a/old"] + sorted(f"ip/b/{index}" for index in range(10))
+    finally:
+        stop_client(client)
+
+def test_config_without_shards_is_rejected():
+    with pytest.raises(ConfigError):
+        ShardedMqttClient(make_config(1883, topic_list=[]), logging.getLogger("test"))
+    with pytest.raises(ConfigError):
+        ShardedMqttClient(make_config(1883, connections=0), logging.getLogger("test"))